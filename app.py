@@ -1,88 +1,65 @@
 import os
+import time
 import requests
-import json
-from flask import Flask, request, abort, jsonify
-from linebot.v3 import WebhookHandler
-from linebot.v3.exceptions import InvalidSignatureError
-from linebot.v3.webhooks import MessageEvent, TextMessageContent, FollowEvent, PostbackEvent
-from datetime import datetime
+from flask import Flask, Response, request, abort, jsonify
 from dotenv import load_dotenv
 import database
+import http_client
+import metrics
+import gazetteer
+import geocoding
+from geocoding import resolve_city
+from forecast import get_forecast_message
+from flex_templates import encode_body
+from webhook_queue import WebhookQueue
+import event_batch
+import user_state
 
 # 環境変数の読み込み
 load_dotenv()
 app = Flask(__name__)
+# テーブルの作成はデプロイ時の python database.py migrate で行う（AUTO_MIGRATE=1 なら起動時にも行う）
 with app.app_context():
-    database.init_db()
+    database.auto_migrate()
 
 # 環境変数から設定を読み込み
 CHANNEL_ACCESS_TOKEN = os.environ.get("LINE_CHANNEL_ACCESS_TOKEN")
 CHANNEL_SECRET = os.environ.get("LINE_CHANNEL_SECRET")
 OPENWEATHER_API_KEY = os.environ.get("OPENWEATHER_API_KEY")
+# リプライトークンの有効期間（秒）。これより古いイベントにはプッシュメッセージで応答する
+REPLY_TOKEN_TTL = int(os.environ.get("REPLY_TOKEN_TTL", "50"))
 
-handler = WebhookHandler(CHANNEL_SECRET)
+_parser = None
 
-# --- 天気情報取得関連の関数 ---
-def get_coords_from_city(city_name):
-    api_url = f"http://api.openweathermap.org/geo/1.0/direct?q={city_name},JP&limit=1&appid={OPENWEATHER_API_KEY}"
-    try:
-        response = requests.get(api_url)
-        response.raise_for_status()
-        data = response.json()
-        if data:
-            return {"lat": data[0]["lat"], "lon": data[0]["lon"]}
-        return None
-    except Exception as e:
-        print(f"Geocoding API Error: {e}")
-        return None
-
-def get_open_meteo_forecast_message_dict(lat, lon, city_name):
-    api_url = f"https://api.open-meteo.com/v1/forecast?latitude={lat}&longitude={lon}&daily=weather_code,temperature_2m_max,temperature_2m_min,precipitation_probability_max&timezone=Asia%2FTokyo"
-    try:
-        response = requests.get(api_url)
-        response.raise_for_status()
-        data = response.json()
-        today = data["daily"]
-        date_str = datetime.strptime(today["time"][0], '%Y-%m-%d').strftime('%Y年%m月%d日')
-        temp_max = today["temperature_2m_max"][0]
-        temp_min = today["temperature_2m_min"][0]
-        pop = today["precipitation_probability_max"][0]
-        weather_codes = {0:"快晴",1:"晴れ",2:"一部曇",3:"曇り",45:"霧",48:"霧氷",51:"霧雨",53:"霧雨",55:"霧雨",56:"着氷性の霧雨",57:"着氷性の霧雨",61:"小雨",63:"雨",65:"大雨",66:"着氷性の雨",67:"着氷性の雨",71:"小雪",73:"雪",75:"大雪",77:"霧雪",80:"にわか雨",81:"にわか雨",82:"激しいにわか雨",85:"弱いしゅう雪",86:"強いしゅう雪",95:"雷雨",96:"雷雨と雹",99:"雷雨と雹"}
-        weather = weather_codes.get(today["weather_code"][0], "不明")
-
-        return {
-            "type": "flex", "altText": f"{city_name}の天気予報",
-            "contents": { "type": "bubble", "direction": 'ltr',
-                "header": {"type": "box", "layout": "vertical", "contents": [{"type": "text", "text": "今日の天気予報", "weight": "bold", "size": "xl", "color": "#FFFFFF", "align": "center"}], "backgroundColor": "#5C6BC0", "paddingTop": "12px", "paddingBottom": "12px"},
-                "body": {"type": "box", "layout": "vertical", "spacing": "md", "contents": [
-                    {"type": "box", "layout": "vertical", "contents": [{"type": "text", "text": city_name, "size": "lg", "weight": "bold", "color": "#5C6BC0", "wrap": True}, {"type": "text", "text": date_str, "size": "sm", "color": "#AAAAAA"}]},
-                    {"type": "separator", "margin": "md"},
-                    {"type": "box", "layout": "vertical", "margin": "lg", "spacing": "sm", "contents": [
-                        {"type": "box", "layout": "baseline", "spacing": "sm", "contents": [{"type": "text", "text": "天気", "color": "#AAAAAA", "size": "sm", "flex": 2}, {"type": "text", "text": weather, "wrap": True, "color": "#666666", "size": "sm", "flex": 5}]},
-                        {"type": "box", "layout": "baseline", "spacing": "sm", "contents": [{"type": "text", "text": "最高気温", "color": "#AAAAAA", "size": "sm", "flex": 2}, {"type": "text", "text": f"{temp_max}°C", "wrap": True, "color": "#666666", "size": "sm", "flex": 5}]},
-                        {"type": "box", "layout": "baseline", "spacing": "sm", "contents": [{"type": "text", "text": "最低気温", "color": "#AAAAAA", "size": "sm", "flex": 2}, {"type": "text", "text": f"{temp_min}°C", "wrap": True, "color": "#666666", "size": "sm", "flex": 5}]},
-                        {"type": "box", "layout": "baseline", "spacing": "sm", "contents": [{"type": "text", "text": "降水確率", "color": "#AAAAAA", "size": "sm", "flex": 2}, {"type": "text", "text": f"{pop}%", "wrap": True, "color": "#666666", "size": "sm", "flex": 5}]}
-                    ]}
-                ]}
-            }
-        }
-    except Exception as e:
-        print(f"Open-Meteo API Error: {e}")
-        return {"type": "text", "text": "天気情報の取得に失敗しました。"}
+def get_parser():
+    """LINEのWebhookパーサーを返す関数（linebot.v3の読み込みに時間がかかるため、最初に使うときに作成する）"""
+    global _parser
+    if _parser is None:
+        from linebot.v3 import WebhookParser
+        _parser = WebhookParser(CHANNEL_SECRET)
+    return _parser
+
+def preload():
+    """linebot.v3の読み込み・DBエンジンの作成・地名辞書の読み込みを済ませておく関数
+    gunicornのpreload_app時に、fork前のマスタープロセスで1回だけ呼ぶ（gunicorn.conf.py）。"""
+    get_parser()
+    database.get_engine()
+    gazetteer.get_gazetteer()
 
 # --- LINE Messaging APIとの通信を行う関数 ---
 def send_line_message(token, messages, is_push=False, user_id=None):
     headers = {"Content-Type": "application/json", "Authorization": f"Bearer {CHANNEL_ACCESS_TOKEN}"}
     if is_push:
-        url, body = "https://api.line.me/v2/bot/message/push", {"to": user_id, "messages": messages}
+        url, fields = f"{http_client.LINE_API_BASE_URL}/v2/bot/message/push", {"to": user_id}
     else:
-        url, body = "https://api.line.me/v2/bot/message/reply", {"replyToken": token, "messages": messages}
+        url, fields = f"{http_client.LINE_API_BASE_URL}/v2/bot/message/reply", {"replyToken": token}
     
     try:
-        encoded_body = json.dumps(body, ensure_ascii=False).encode('utf-8')
-        response = requests.post(url, headers=headers, data=encoded_body)
-        print(f"LINE API Response Status: {response.status_code}")
-        response.raise_for_status()
+        with metrics.timed("line_send", "push" if is_push else "reply"):
+            encoded_body = encode_body(fields, messages)
+            response = http_client.post(url, headers=headers, data=encoded_body)
+            print(f"LINE API Response Status: {response.status_code}")
+            response.raise_for_status()
         print("LINEメッセージの送信に成功しました。")
 
     except requests.exceptions.RequestException as e:
@@ -92,63 +69,113 @@ def send_line_message(token, messages, is_push=False, user_id=None):
             print(f"応答内容(text): {e.response.text}")
         print("--- エラー情報ここまで ---")
 
+def reply_to_event(event, messages):
+    """イベントに返信する関数。リプライトークンが期限切れの可能性がある場合はプッシュメッセージで送る"""
+    age = time.time() - event.timestamp / 1000
+    is_redelivery = event.delivery_context is not None and event.delivery_context.is_redelivery
+    if age > REPLY_TOKEN_TTL or is_redelivery or not event.reply_token:
+        print(f"リプライトークンが使えないため、プッシュメッセージで応答します。(受信から{age:.1f}秒)")
+        send_line_message(None, messages, is_push=True, user_id=event.source.user_id)
+    else:
+        send_line_message(event.reply_token, messages)
+
 # --- Webhookの受付部分 ---
 @app.route('/ping', methods=['GET'])
 def ping():
     return jsonify({"status": "ok"})
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    return Response(metrics.render_prometheus(), mimetype="text/plain; version=0.0.4")
+@app.route('/stats', methods=['GET'])
+def stats():
+    return jsonify({"geocode_cache": geocoding.get_cache_stats(), "user_state_cache": user_state.get_cache_stats(), "webhook_queue": webhook_queue.stats(), "http": http_client.get_stats()})
 @app.route("/callback", methods=['POST'])
 def callback():
     signature = request.headers['X-Line-Signature']
     body = request.get_data(as_text=True)
-    try:
-        handler.handle(body, signature)
-    except InvalidSignatureError:
+    with metrics.maybe_profile("callback"), metrics.timed("webhook", "callback") as timer:
+        from linebot.v3.exceptions import InvalidSignatureError
+        try:
+            events = get_parser().parse(body, signature)
+        except InvalidSignatureError:
+            events = None
+            timer.outcome = "invalid_signature"
+        else:
+            # 署名の検証だけ行ってすぐに応答し、イベントの処理はワーカーに任せる
+            webhook_queue.enqueue([event for event in events if event.type in HANDLED_EVENT_TYPES])
+    # abort()は例外で応答するため、計測のブロックの外で呼ぶ（中で呼ぶとoutcomeが"error"になる）
+    if events is None:
         abort(400)
     return 'OK'
 
 # --- LINEイベントのハンドラ ---
 
-@handler.add(FollowEvent)
-def handle_follow(event):
+# イベントの種類はクラスではなくtypeで判定する（linebot.v3.webhooksをimportせずに済むように）
+HANDLED_EVENT_TYPES = ("follow", "postback", "message")
+
+def handle_event(event, batch):
+    """イベントを、種類に応じたハンドラへ振り分ける関数"""
+    if event.type == "follow":
+        handle_follow(event, batch)
+    elif event.type == "postback":
+        handle_postback(event, batch)
+    elif event.type == "message" and event.message.type == "text":
+        handle_message(event, batch)
+
+def handle_delivery(events):
+    """キューから取り出した1回の配信分のイベントを、ユーザー状態の読み書きをまとめて処理する関数"""
+    with metrics.maybe_profile("webhook_delivery"):
+        event_batch.process_events(events, handle_event)
+
+webhook_queue = WebhookQueue(handle_delivery)
+
+def handle_follow(event, batch):
     user_id = event.source.user_id
     
     # 友達追加と同時に、ユーザーの状態を「地点入力を待っている状態」に設定
-    database.set_user_state(user_id, 'waiting_for_location')
+    batch.set_state(user_id, 'waiting_for_location')
     
     # 地点登録を促すメッセージを送信
     reply_messages = [{"type": "text", "text": "友達追加ありがとうございます！\nこのアカウントは毎日0時にあなたの設定した地点の天気予報をお届けします。\n早速ですが、毎日の天気予報を通知する地点を教えてください！\n（例: 大阪市, 新宿区）"}]
-    send_line_message(event.reply_token, reply_messages)
+    reply_to_event(event, reply_messages)
 
-@handler.add(PostbackEvent)
-def handle_postback(event):
+def handle_postback(event, batch):
     user_id = event.source.user_id
     if event.postback.data == 'action=register_location':
         reply_messages = [{"type": "text", "text": "新しく通知を受け取りたい地点（例: 大阪市, 新宿区）を教えてください。"}]
-        send_line_message(event.reply_token, reply_messages)
-        database.set_user_state(user_id, 'waiting_for_location')
+        reply_to_event(event, reply_messages)
+        batch.set_state(user_id, 'waiting_for_location')
+
+def build_suggestion_message(text, labels):
+    """候補の地名をクイックリプライのボタンで選べるテキストメッセージを作る関数"""
+    items = [{"type": "action", "action": {"type": "message", "label": label[:20], "text": label}} for label in labels]
+    return {"type": "text", "text": text, "quickReply": {"items": items}}
 
-@handler.add(MessageEvent, message=TextMessageContent)
-def handle_message(event):
+def handle_message(event, batch):
     user_id = event.source.user_id
     user_message = event.message.text
-    user_state = database.get_user_state(user_id)
+    user_state = batch.get_state(user_id)
+    coords, city_name, suggestions = resolve_city(user_message)
     
     if user_state == 'waiting_for_location':
-        coords = get_coords_from_city(user_message)
         if coords:
-            database.set_user_location(user_id, user_message, coords['lat'], coords['lon'])
-            reply_message = {"type": "text", "text": f"地点を「{user_message}」に設定しました！"}
+            batch.set_location(user_id, city_name, coords['lat'], coords['lon'])
+            reply_message = {"type": "text", "text": f"地点を「{city_name}」に設定しました！"}
+        elif suggestions:
+            reply_message = build_suggestion_message(f"「{user_message}」に近い地点の候補です。通知を受け取りたい地点を選んでください。", suggestions)
         else:
             reply_message = {"type": "text", "text": f"「{user_message}」が見つかりませんでした。日本の市町村名などで入力してください。"}
-        send_line_message(event.reply_token, [reply_message])
+        reply_to_event(event, [reply_message])
     else:
-        coords = get_coords_from_city(user_message)
         if coords:
-            forecast_message = get_open_meteo_forecast_message_dict(coords['lat'], coords['lon'], user_message)
-            send_line_message(event.reply_token, [forecast_message])
+            forecast_message = get_forecast_message(coords['lat'], coords['lon'], city_name)
+            reply_to_event(event, [forecast_message])
+        elif suggestions:
+            reply_message = build_suggestion_message(f"「{user_message}」に近い地点の候補です。天気を知りたい地点を選んでください。", suggestions)
+            reply_to_event(event, [reply_message])
         else:
             reply_message = {"type": "text", "text": "地名が見つかりませんでした。メニューの「登録地点を変更」から地点を登録するか、地名を入力して天気を検索できます。"}
-            send_line_message(event.reply_token, [reply_message])
+            reply_to_event(event, [reply_message])
 
 # --- アプリケーションの実行 ---
 if __name__ == "__main__":
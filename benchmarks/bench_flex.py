@@ -0,0 +1,65 @@
+"""天気予報Flex Messageの組み立て・エンコードにかかる時間を、テンプレート導入前後で比較するマイクロベンチマーク
+
+使い方: python benchmarks/bench_flex.py [受信者数]
+"""
+import os
+import sys
+import json
+import timeit
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import forecast
+from flex_templates import encode_body
+
+DAILY = {"time": ["2026-10-18"], "weather_code": [61], "temperature_2m_max": [22.4], "temperature_2m_min": [15.1], "precipitation_probability_max": [60]}
+
+def legacy_build_message_dict(daily, city_name):
+    """テンプレート導入前の実装（呼び出しのたびに天気コード表とFlex Messageの辞書を組み立てる）"""
+    date_str = datetime.strptime(daily["time"][0], '%Y-%m-%d').strftime('%Y年%m月%d日')
+    temp_max = daily["temperature_2m_max"][0]
+    temp_min = daily["temperature_2m_min"][0]
+    pop = daily["precipitation_probability_max"][0]
+    weather_codes = {0:"快晴",1:"晴れ",2:"一部曇",3:"曇り",45:"霧",48:"霧氷",51:"霧雨",53:"霧雨",55:"霧雨",56:"着氷性の霧雨",57:"着氷性の霧雨",61:"小雨",63:"雨",65:"大雨",66:"着氷性の雨",67:"着氷性の雨",71:"小雪",73:"雪",75:"大雪",77:"霧雪",80:"にわか雨",81:"にわか雨",82:"激しいにわか雨",85:"弱いしゅう雪",86:"強いしゅう雪",95:"雷雨",96:"雷雨と雹",99:"雷雨と雹"}
+    weather = weather_codes.get(daily["weather_code"][0], "不明")
+    return {
+        "type": "flex", "altText": f"{city_name}の天気予報",
+        "contents": { "type": "bubble", "direction": 'ltr',
+            "header": {"type": "box", "layout": "vertical", "contents": [{"type": "text", "text": "今日の天気予報", "weight": "bold", "size": "xl", "color": "#FFFFFF", "align": "center"}], "backgroundColor": "#5C6BC0", "paddingTop": "12px", "paddingBottom": "12px"},
+            "body": {"type": "box", "layout": "vertical", "spacing": "md", "contents": [
+                {"type": "box", "layout": "vertical", "contents": [{"type": "text", "text": city_name, "size": "lg", "weight": "bold", "color": "#5C6BC0", "wrap": True}, {"type": "text", "text": date_str, "size": "sm", "color": "#AAAAAA"}]},
+                {"type": "separator", "margin": "md"},
+                {"type": "box", "layout": "vertical", "margin": "lg", "spacing": "sm", "contents": [
+                    {"type": "box", "layout": "baseline", "spacing": "sm", "contents": [{"type": "text", "text": "天気", "color": "#AAAAAA", "size": "sm", "flex": 2}, {"type": "text", "text": weather, "wrap": True, "color": "#666666", "size": "sm", "flex": 5}]},
+                    {"type": "box", "layout": "baseline", "spacing": "sm", "contents": [{"type": "text", "text": "最高気温", "color": "#AAAAAA", "size": "sm", "flex": 2}, {"type": "text", "text": f"{temp_max}°C", "wrap": True, "color": "#666666", "size": "sm", "flex": 5}]},
+                    {"type": "box", "layout": "baseline", "spacing": "sm", "contents": [{"type": "text", "text": "最低気温", "color": "#AAAAAA", "size": "sm", "flex": 2}, {"type": "text", "text": f"{temp_min}°C", "wrap": True, "color": "#666666", "size": "sm", "flex": 5}]},
+                    {"type": "box", "layout": "baseline", "spacing": "sm", "contents": [{"type": "text", "text": "降水確率", "color": "#AAAAAA", "size": "sm", "flex": 2}, {"type": "text", "text": f"{pop}%", "wrap": True, "color": "#666666", "size": "sm", "flex": 5}]}
+                ]}
+            ]}
+        }
+    }
+
+def legacy_push_body(user_id):
+    message = legacy_build_message_dict(DAILY, "大阪市")
+    return json.dumps({"to": user_id, "messages": [message]}, ensure_ascii=False).encode('utf-8')
+
+def template_push_body(user_id):
+    message = forecast.build_forecast_message(DAILY, "大阪市")
+    return encode_body({"to": user_id}, [message])
+
+def template_uncached_push_body(user_id):
+    forecast._render_forecast_message.cache_clear()
+    return template_push_body(user_id)
+
+def measure(label, func, number):
+    seconds = min(timeit.repeat(lambda: func("U0123456789abcdef0123456789abcdef"), number=number, repeat=5))
+    print(f"{label:<40} {seconds / number * 1e6:8.2f} µs/メッセージ")
+
+if __name__ == "__main__":
+    number = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    # どの方式でも、LINE APIが受け取る内容は同じであることを確かめておく
+    assert json.loads(legacy_push_body("U1")) == json.loads(template_push_body("U1"))
+    print(f"{number}件の送信本文（1ユーザー宛てプッシュ）を組み立てた場合の1件あたりの時間")
+    measure("変更前: 辞書の組み立て + json.dumps", legacy_push_body, number)
+    measure("変更後: テンプレート（キャッシュなし）", template_uncached_push_body, number)
+    measure("変更後: テンプレート（同じ予報を再利用）", template_push_body, number)
@@ -0,0 +1,232 @@
+"""Webhook受信と定期通知の負荷試験
+
+LINE・Open-Meteo・ジオコーディングをローカルのモックサーバーに置き換え、
+シードしたusersテーブルに対して次の2つを計測し、結果をJSONで保存する。
+
+- webhook: 署名付きWebhookを並列に送ったときの /callback の応答時間（p50/p99）と、キューでの処理時間
+- notifier: daily_notifier.send_daily_forecasts のスループット（人/秒）と外部APIの呼び出し回数
+
+使い方:
+    python benchmarks/load_test.py --users 10000
+    python benchmarks/load_test.py --users 1000000 --database-url postgresql://... --line-latency-ms 20 --line-error-rate 0.01
+"""
+import os
+import sys
+import json
+import time
+import hmac
+import uuid
+import base64
+import hashlib
+import random
+import argparse
+import tempfile
+import threading
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, ROOT_DIR)
+sys.path.insert(0, BENCH_DIR)
+from mock_upstreams import MockLine, MockOpenMeteo, MockGeocoding
+
+CHANNEL_SECRET = "load-test-channel-secret"
+CITIES = [
+    ("札幌市", 43.06, 141.35), ("仙台市", 38.27, 140.87), ("新宿区", 35.69, 139.70), ("世田谷区", 35.65, 139.65),
+    ("横浜市", 35.44, 139.64), ("川崎市", 35.53, 139.70), ("さいたま市", 35.86, 139.65), ("千葉市", 35.61, 140.12),
+    ("名古屋市", 35.18, 136.91), ("京都市", 35.01, 135.77), ("大阪市", 34.69, 135.50), ("神戸市", 34.69, 135.20),
+    ("広島市", 34.39, 132.46), ("福岡市", 33.59, 130.40), ("那覇市", 26.21, 127.68), ("府中市", 35.67, 139.48),
+]
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))]
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT_DIR, text=True).strip()
+    except Exception:
+        return "unknown"
+
+def seed_users(database, count, unregistered_ratio=0.05):
+    """負荷試験用のユーザー（user_idが "Ubench" で始まる）を作り直す"""
+    from sqlalchemy import text
+    rng = random.Random(0)
+    with database.engine.connect() as connection:
+        connection.execute(text("DELETE FROM users WHERE user_id LIKE 'Ubench%'"))
+        rows = []
+        for i in range(count):
+            city_name, lat, lon = rng.choice(CITIES)
+            if rng.random() < unregistered_ratio:
+                rows.append({"user_id": f"Ubench{i:08d}", "state": "waiting_for_location", "city_name": None, "lat": None, "lon": None})
+            else:
+                rows.append({"user_id": f"Ubench{i:08d}", "state": "normal", "city_name": city_name, "lat": lat, "lon": lon})
+            if len(rows) >= 10000:
+                connection.execute(text("INSERT INTO users (user_id, state, city_name, lat, lon) VALUES (:user_id, :state, :city_name, :lat, :lon)"), rows)
+                rows = []
+        if rows:
+            connection.execute(text("INSERT INTO users (user_id, state, city_name, lat, lon) VALUES (:user_id, :state, :city_name, :lat, :lon)"), rows)
+        connection.commit()
+
+def text_event(user_id, text_value):
+    return {
+        "type": "message", "mode": "active", "timestamp": int(time.time() * 1000),
+        "source": {"type": "user", "userId": user_id}, "webhookEventId": uuid.uuid4().hex,
+        "deliveryContext": {"isRedelivery": False}, "replyToken": uuid.uuid4().hex,
+        "message": {"type": "text", "id": uuid.uuid4().hex[:16], "text": text_value, "quoteToken": "q"},
+    }
+
+def signed_webhook(events):
+    body = json.dumps({"destination": "Ubench", "events": events}, ensure_ascii=False).encode("utf-8")
+    signature = base64.b64encode(hmac.new(CHANNEL_SECRET.encode("utf-8"), body, hashlib.sha256).digest()).decode("ascii")
+    return body, signature
+
+def bench_webhook(app_module, user_count, requests_count, concurrency, events_per_request):
+    """署名付きWebhookを並列に送り、/callbackの応答時間とキューでの処理時間を計測する"""
+    import requests
+    from werkzeug.serving import make_server
+
+    server = make_server("127.0.0.1", 0, app_module.app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_port}/callback"
+    rng = random.Random(1)
+    payloads = []
+    for _ in range(requests_count):
+        events = [text_event(f"Ubench{rng.randrange(user_count):08d}", rng.choice(CITIES)[0]) for _ in range(events_per_request)]
+        payloads.append(signed_webhook(events))
+
+    local = threading.local()
+    latencies = []
+    failures = 0
+    lock = threading.Lock()
+
+    def send(payload):
+        nonlocal failures
+        session = getattr(local, "session", None) or requests.Session()
+        local.session = session
+        body, signature = payload
+        started_at = time.perf_counter()
+        response = session.post(url, data=body, headers={"X-Line-Signature": signature, "Content-Type": "application/json"})
+        elapsed = time.perf_counter() - started_at
+        with lock:
+            latencies.append(elapsed)
+            if response.status_code != 200:
+                failures += 1
+
+    started_at = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(send, payloads))
+    load_seconds = time.perf_counter() - started_at
+
+    # キューに積まれた配信の処理が終わるまで待つ
+    total_events = requests_count * events_per_request
+    deadline = time.time() + 300
+    while time.time() < deadline:
+        stats = app_module.webhook_queue.stats()
+        if stats["processing"]["count"] >= requests_count:
+            break
+        time.sleep(0.05)
+    drain_seconds = time.perf_counter() - started_at
+    server.shutdown()
+
+    return {
+        "requests": requests_count,
+        "events": total_events,
+        "concurrency": concurrency,
+        "failures": failures,
+        "requests_per_sec": requests_count / load_seconds if load_seconds else 0.0,
+        "latency_p50_ms": percentile(latencies, 50) * 1000,
+        "latency_p99_ms": percentile(latencies, 99) * 1000,
+        "latency_max_ms": max(latencies) * 1000 if latencies else 0.0,
+        "events_processed_per_sec": total_events / drain_seconds if drain_seconds else 0.0,
+        "queue": app_module.webhook_queue.stats(),
+    }
+
+def bench_notifier(daily_notifier):
+    """定期通知を1回実行し、スループットを計測する"""
+    run_id = f"bench-{uuid.uuid4().hex[:8]}"
+    started_at = time.perf_counter()
+    daily_notifier.send_daily_forecasts(run_id=run_id)
+    return {"run_id": run_id, "seconds": time.perf_counter() - started_at}
+
+def main():
+    arg_parser = argparse.ArgumentParser(description="Webhook受信と定期通知の負荷試験")
+    arg_parser.add_argument("--users", type=int, default=10000, help="シードするユーザー数")
+    arg_parser.add_argument("--database-url", help="使用するDB（省略時は一時ディレクトリのSQLite）")
+    arg_parser.add_argument("--webhook-requests", type=int, default=2000)
+    arg_parser.add_argument("--webhook-concurrency", type=int, default=32)
+    arg_parser.add_argument("--events-per-request", type=int, default=1)
+    arg_parser.add_argument("--line-latency-ms", type=float, default=5.0)
+    arg_parser.add_argument("--line-error-rate", type=float, default=0.0)
+    arg_parser.add_argument("--open-meteo-latency-ms", type=float, default=50.0)
+    arg_parser.add_argument("--open-meteo-error-rate", type=float, default=0.0)
+    arg_parser.add_argument("--geocoding-latency-ms", type=float, default=30.0)
+    arg_parser.add_argument("--geocoding-error-rate", type=float, default=0.0)
+    arg_parser.add_argument("--skip-webhook", action="store_true")
+    arg_parser.add_argument("--skip-notifier", action="store_true")
+    arg_parser.add_argument("--output", help="結果のJSONの保存先（省略時は benchmarks/results/load_test-<コミット>.json）")
+    args = arg_parser.parse_args()
+
+    line = MockLine("line", args.line_latency_ms, args.line_error_rate, seed=1).start()
+    open_meteo = MockOpenMeteo("open_meteo", args.open_meteo_latency_ms, args.open_meteo_error_rate, seed=2).start()
+    geocoding = MockGeocoding("geocoding", args.geocoding_latency_ms, args.geocoding_error_rate, seed=3).start()
+
+    # アプリのモジュールは環境変数を読み込み時に参照するため、設定してからimportする
+    tmp_dir = tempfile.mkdtemp(prefix="load_test-")
+    os.environ.update({
+        "DATABASE_URL": args.database_url or f"sqlite:///{os.path.join(tmp_dir, 'bench.db')}",
+        "LINE_CHANNEL_SECRET": CHANNEL_SECRET,
+        "LINE_CHANNEL_ACCESS_TOKEN": "load-test-token",
+        "OPENWEATHER_API_KEY": "load-test-key",
+        "LINE_API_BASE_URL": line.base_url,
+        "OPEN_METEO_BASE_URL": open_meteo.base_url,
+        "OPENWEATHER_BASE_URL": geocoding.base_url,
+    })
+    os.environ.setdefault("DISPATCH_RATE_PER_SEC", "100000")
+    os.environ.setdefault("DISPATCH_BACKOFF_BASE", "0.01")
+
+    import database
+    database.init_db()
+    seed_started_at = time.perf_counter()
+    seed_users(database, args.users)
+    print(f"{args.users}人のユーザーをシードしました。({time.perf_counter() - seed_started_at:.1f}秒)")
+
+    result = {
+        "commit": git_commit(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "config": vars(args),
+        "database": database.engine.dialect.name,
+    }
+
+    if not args.skip_webhook:
+        import app
+        # 本番（gunicornのpreload_app）と同じく、重いモジュールの読み込みは計測前に済ませておく
+        app.preload()
+        before = {upstream.name: upstream.stats()["total_calls"] for upstream in (line, open_meteo, geocoding)}
+        result["webhook"] = bench_webhook(app, args.users, args.webhook_requests, args.webhook_concurrency, args.events_per_request)
+        result["webhook"]["upstream_calls"] = {upstream.name: upstream.stats()["total_calls"] - before[upstream.name] for upstream in (line, open_meteo, geocoding)}
+        print(f"webhook: p50 {result['webhook']['latency_p50_ms']:.1f}ms, p99 {result['webhook']['latency_p99_ms']:.1f}ms, {result['webhook']['requests_per_sec']:.0f} req/s")
+
+    if not args.skip_notifier:
+        import daily_notifier
+        before = {upstream.name: upstream.stats() for upstream in (line, open_meteo, geocoding)}
+        notifier = bench_notifier(daily_notifier)
+        after = {upstream.name: upstream.stats() for upstream in (line, open_meteo, geocoding)}
+        notifier["upstream_calls"] = {name: after[name]["total_calls"] - before[name]["total_calls"] for name in after}
+        notifier["line_recipients"] = after["line"]["recipients"] - before["line"]["recipients"]
+        notifier["users_per_sec"] = notifier["line_recipients"] / notifier["seconds"] if notifier["seconds"] else 0.0
+        result["notifier"] = notifier
+        print(f"notifier: {notifier['line_recipients']}人 / {notifier['seconds']:.1f}秒 ({notifier['users_per_sec']:.0f}人/秒), 外部API呼び出し: {notifier['upstream_calls']}")
+
+    result["upstreams"] = {upstream.name: upstream.stats() for upstream in (line, open_meteo, geocoding)}
+    output = args.output or os.path.join(BENCH_DIR, "results", f"load_test-{result['commit']}.json")
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(result, f, ensure_ascii=False, indent=2)
+    print(f"結果を {output} に保存しました。")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,136 @@
+"""LINE Messaging API・Open-Meteo・OpenWeatherMapジオコーディングの代わりをするローカルのモックサーバー
+
+負荷試験（benchmarks/load_test.py）から使う。各サーバーには応答の遅延とエラー率を設定できる。
+"""
+import json
+import time
+import random
+import threading
+from collections import Counter
+from urllib.parse import urlsplit, parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+class MockUpstream:
+    """1つの外部サービスを模したHTTPサーバー（別スレッドで動作する）"""
+
+    def __init__(self, name, latency_ms=0.0, error_rate=0.0, seed=None):
+        self.name = name
+        self.latency = latency_ms / 1000
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.calls = Counter()
+        self.errors = Counter()
+        self.recipients = 0
+        upstream = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                upstream._handle(self, "GET")
+
+            def do_POST(self):
+                upstream._handle(self, "POST")
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        self.base_url = f"http://127.0.0.1:{self.server.server_port}"
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+
+    def _handle(self, handler, method):
+        url = urlsplit(handler.path)
+        length = int(handler.headers.get("Content-Length") or 0)
+        body = handler.rfile.read(length) if length else b""
+        with self.lock:
+            self.calls[url.path] += 1
+            fail = self.random.random() < self.error_rate
+            if fail:
+                self.errors[url.path] += 1
+        if self.latency:
+            time.sleep(self.latency)
+        if fail:
+            self._respond(handler, 503, {"message": "mock error"}, {"Retry-After": "0"})
+            return
+        status, payload = self.respond(method, url.path, parse_qs(url.query), body)
+        self._respond(handler, status, payload)
+
+    def _respond(self, handler, status, payload, headers=None):
+        data = json.dumps(payload).encode("utf-8")
+        handler.send_response(status)
+        handler.send_header("Content-Type", "application/json")
+        handler.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            handler.send_header(name, value)
+        handler.end_headers()
+        handler.wfile.write(data)
+
+    def respond(self, method, path, query, body):
+        """(ステータスコード, 応答JSON) を返す。サービスごとに上書きする"""
+        return 404, {"message": "not found"}
+
+    def stats(self):
+        with self.lock:
+            return {
+                "base_url": self.base_url,
+                "calls": dict(self.calls),
+                "errors": dict(self.errors),
+                "total_calls": sum(self.calls.values()),
+                "recipients": self.recipients,
+            }
+
+class MockLine(MockUpstream):
+    """LINE Messaging APIの reply / push / multicast エンドポイント"""
+
+    def respond(self, method, path, query, body):
+        if method != "POST" or path not in ("/v2/bot/message/reply", "/v2/bot/message/push", "/v2/bot/message/multicast"):
+            return 404, {"message": "not found"}
+        request_body = json.loads(body)
+        to = request_body.get("to")
+        with self.lock:
+            self.recipients += len(to) if isinstance(to, list) else 1
+        return 200, {}
+
+class MockOpenMeteo(MockUpstream):
+    """Open-Meteoの /v1/forecast（カンマ区切りの複数地点指定に対応）"""
+
+    def respond(self, method, path, query, body):
+        if path != "/v1/forecast":
+            return 404, {"reason": "not found"}
+        latitudes = query["latitude"][0].split(",")
+        longitudes = query["longitude"][0].split(",")
+        days = int(query.get("forecast_days", ["1"])[0])
+        today = time.strftime("%Y-%m-%d", time.gmtime(time.time() + 9 * 3600))
+        tomorrow = time.strftime("%Y-%m-%d", time.gmtime(time.time() + 33 * 3600))
+        items = [{
+            "latitude": float(lat), "longitude": float(lon),
+            "daily": {
+                "time": [today, tomorrow][:days],
+                "weather_code": [self.random.choice([0, 1, 3, 61, 80])] * days,
+                "temperature_2m_max": [round(20 + self.random.random() * 10, 1)] * days,
+                "temperature_2m_min": [round(10 + self.random.random() * 5, 1)] * days,
+                "precipitation_probability_max": [self.random.choice([0, 10, 30, 60])] * days,
+            },
+        } for lat, lon in zip(latitudes, longitudes)]
+        return 200, items[0] if len(items) == 1 else items
+
+class MockGeocoding(MockUpstream):
+    """OpenWeatherMapの /geo/1.0/direct（地名のハッシュから日本国内の座標を作る）"""
+
+    def respond(self, method, path, query, body):
+        if path != "/geo/1.0/direct":
+            return 404, {"message": "not found"}
+        name = query["q"][0].split(",")[0]
+        if name.startswith("存在しない"):
+            return 200, []
+        seed = sum(name.encode("utf-8"))
+        return 200, [{"name": name, "lat": 31 + seed % 1200 / 100, "lon": 130 + seed % 1100 / 100, "country": "JP"}]
@@ -0,0 +1,171 @@
+"""Webサービスと定期実行スクリプトの起動時間の計測
+
+エントリーポイント（app / daily_notifier / prompt_location）ごとに、新しいPythonプロセスで次を計測し、結果をJSONで保存する。
+
+- import: python -X importtime によるモジュールの読み込み時間と、時間のかかっている直下のモジュール
+- first_response（appのみ）: プロセス起動から /ping と、最初の /callback（署名付き・イベントなし）に応答するまでの時間
+- preload（appのみ）: gunicornのpreload_app時にマスタープロセスで行う app.preload() の時間
+
+使い方:
+    python benchmarks/startup.py
+    python benchmarks/startup.py --repeat 10 --database-url postgresql://...
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import statistics
+import subprocess
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(BENCH_DIR)
+
+ENTRY_POINTS = ("app", "daily_notifier", "prompt_location")
+CHANNEL_SECRET = "startup-channel-secret"
+
+# 子プロセスで実行する、appの最初の応答までの計測
+FIRST_RESPONSE_SCRIPT = """
+import time
+started_at = time.perf_counter()
+import json, hmac, base64, hashlib
+import app
+imported_at = time.perf_counter()
+client = app.app.test_client()
+client.get("/ping")
+pinged_at = time.perf_counter()
+body = json.dumps({"destination": "startup", "events": []})
+signature = base64.b64encode(hmac.new(CHANNEL_SECRET.encode(), body.encode(), hashlib.sha256).digest()).decode()
+status = client.post("/callback", data=body, headers={"X-Line-Signature": signature}).status_code
+called_back_at = time.perf_counter()
+app.preload()
+preloaded_at = time.perf_counter()
+print(json.dumps({
+    "import_ms": (imported_at - started_at) * 1000,
+    "first_ping_ms": (pinged_at - started_at) * 1000,
+    "first_callback_ms": (called_back_at - started_at) * 1000,
+    "callback_status": status,
+    "preload_after_first_request_ms": (preloaded_at - called_back_at) * 1000,
+}))
+"""
+
+# 子プロセスで実行する、preload（gunicornのマスタープロセスでの処理）後の最初の応答までの計測
+PRELOADED_RESPONSE_SCRIPT = """
+import time
+started_at = time.perf_counter()
+import json, hmac, base64, hashlib
+import app
+app.preload()
+preloaded_at = time.perf_counter()
+client = app.app.test_client()
+body = json.dumps({"destination": "startup", "events": []})
+signature = base64.b64encode(hmac.new(CHANNEL_SECRET.encode(), body.encode(), hashlib.sha256).digest()).decode()
+client.post("/callback", data=body, headers={"X-Line-Signature": signature})
+called_back_at = time.perf_counter()
+print(json.dumps({
+    "preload_ms": (preloaded_at - started_at) * 1000,
+    "first_callback_after_preload_ms": (called_back_at - preloaded_at) * 1000,
+}))
+"""
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT_DIR, text=True).strip()
+    except Exception:
+        return "unknown"
+
+def run_python(args, env):
+    """ROOT_DIRで新しいPythonプロセスを実行し、(標準出力, 標準エラー出力, 経過秒数) を返す"""
+    started_at = time.perf_counter()
+    completed = subprocess.run([sys.executable] + args, cwd=ROOT_DIR, env=env, capture_output=True, text=True, check=True)
+    return completed.stdout, completed.stderr, time.perf_counter() - started_at
+
+def parse_importtime(stderr, module, top):
+    """-X importtime の出力から、モジュール全体の読み込み時間と、時間のかかっている直下のモジュールを返す"""
+    total_us, children = 0, []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = line.split("|")
+        if not cumulative.strip().isdigit():
+            continue
+        if name.strip() == module and not name.startswith("  "):
+            total_us = int(cumulative)
+        elif name.startswith("   ") and not name.startswith("    "):
+            children.append((name.strip(), int(cumulative)))
+    children.sort(key=lambda item: item[1], reverse=True)
+    return total_us / 1000, [{"module": name, "ms": us / 1000} for name, us in children[:top]]
+
+def bench_import(module, env, repeat, top):
+    """-X importtime で複数回読み込み、中央値と、中央値の回の内訳を返す"""
+    runs = []
+    for _ in range(repeat):
+        _, stderr, seconds = run_python(["-X", "importtime", "-c", f"import {module}"], env)
+        total_ms, breakdown = parse_importtime(stderr, module, top)
+        runs.append({"import_ms": total_ms, "process_ms": seconds * 1000, "breakdown": breakdown})
+    runs.sort(key=lambda run: run["import_ms"])
+    median = runs[len(runs) // 2]
+    return {
+        "import_ms": median["import_ms"],
+        "import_ms_min": runs[0]["import_ms"],
+        "process_ms": statistics.median(run["process_ms"] for run in runs),
+        "slowest_imports": median["breakdown"],
+    }
+
+def bench_script(script, env, repeat):
+    """計測用のスクリプトを複数回実行し、項目ごとの中央値を返す"""
+    runs = []
+    for _ in range(repeat):
+        stdout, _, seconds = run_python(["-c", f"CHANNEL_SECRET = {CHANNEL_SECRET!r}\n" + script], env)
+        run = json.loads(stdout.strip().splitlines()[-1])
+        run["process_ms"] = seconds * 1000
+        runs.append(run)
+    return {key: statistics.median(run[key] for run in runs) for key in runs[0]}
+
+def main():
+    arg_parser = argparse.ArgumentParser(description="Webサービスと定期実行スクリプトの起動時間の計測")
+    arg_parser.add_argument("--repeat", type=int, default=5, help="エントリーポイントごとの計測回数（中央値を記録する）")
+    arg_parser.add_argument("--top", type=int, default=10, help="記録する、時間のかかっている直下のモジュールの数")
+    arg_parser.add_argument("--database-url", help="使用するDB（省略時は一時ディレクトリのSQLite）")
+    arg_parser.add_argument("--output", help="結果のJSONの保存先（省略時は benchmarks/results/startup-<コミット>.json）")
+    args = arg_parser.parse_args()
+
+    tmp_dir = tempfile.mkdtemp(prefix="startup-")
+    env = dict(os.environ)
+    env.update({
+        "DATABASE_URL": args.database_url or f"sqlite:///{os.path.join(tmp_dir, 'startup.db')}",
+        "LINE_CHANNEL_SECRET": CHANNEL_SECRET,
+        "LINE_CHANNEL_ACCESS_TOKEN": "startup-token",
+        "WEBHOOK_QUEUE_MODE": "memory",
+    })
+    # テーブルの作成は計測に含めない（本番と同じく、デプロイ時に済ませておく）
+    env.pop("AUTO_MIGRATE", None)
+    run_python(["database.py", "migrate"], env)
+
+    result = {
+        "commit": git_commit(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "config": vars(args),
+        "python": sys.version.split()[0],
+        "entry_points": {},
+    }
+    for module in ENTRY_POINTS:
+        result["entry_points"][module] = bench_import(module, env, args.repeat, args.top)
+        print(f"{module}: import {result['entry_points'][module]['import_ms']:.0f}ms (プロセス全体 {result['entry_points'][module]['process_ms']:.0f}ms)")
+
+    result["entry_points"]["app"]["first_response"] = bench_script(FIRST_RESPONSE_SCRIPT, env, args.repeat)
+    result["entry_points"]["app"]["preloaded"] = bench_script(PRELOADED_RESPONSE_SCRIPT, env, args.repeat)
+    first_response = result["entry_points"]["app"]["first_response"]
+    preloaded = result["entry_points"]["app"]["preloaded"]
+    print(f"app: 最初の /ping {first_response['first_ping_ms']:.0f}ms, 最初の /callback {first_response['first_callback_ms']:.0f}ms")
+    print(f"app: preload {preloaded['preload_ms']:.0f}ms, preload後の最初の /callback {preloaded['first_callback_after_preload_ms']:.1f}ms")
+
+    output = args.output or os.path.join(BENCH_DIR, "results", f"startup-{result['commit']}.json")
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(result, f, ensure_ascii=False, indent=2)
+    print(f"結果を {output} に保存しました。")
+
+if __name__ == "__main__":
+    main()
@@ -2,6 +2,7 @@ import os
 import requests
 import json
 from dotenv import load_dotenv
+import http_client
 
 load_dotenv()
 CHANNEL_ACCESS_TOKEN = os.environ.get("LINE_CHANNEL_ACCESS_TOKEN")
@@ -22,38 +23,39 @@ def create_rich_menu():
             }
         ]
     }
-    create_url = "https://api.line.me/v2/bot/richmenu"
+    create_url = f"{http_client.LINE_API_BASE_URL}/v2/bot/richmenu"
     headers = {"Authorization": f"Bearer {CHANNEL_ACCESS_TOKEN}", "Content-Type": "application/json"}
     try:
         # 既に同じ名前のメニューがあれば削除
-        menu_list_res = requests.get("https://api.line.me/v2/bot/richmenu/list", headers=headers)
+        menu_list_res = http_client.get(f"{http_client.LINE_API_BASE_URL}/v2/bot/richmenu/list", headers=headers)
         for menu in menu_list_res.json().get('richmenus', []):
             if menu.get('name') == rich_menu_body['name']:
-                delete_url = f"https://api.line.me/v2/bot/richmenu/{menu['richMenuId']}"
-                requests.delete(delete_url, headers=headers)
+                delete_url = f"{http_client.LINE_API_BASE_URL}/v2/bot/richmenu/{menu['richMenuId']}"
+                http_client.delete(delete_url, headers=headers)
                 print(f"古いメニュー(ID: {menu['richMenuId']})を削除しました。")
 
         # 新しいメニューを作成
-        response = requests.post(create_url, headers=headers, data=json.dumps(rich_menu_body))
+        response = http_client.post(create_url, headers=headers, data=json.dumps(rich_menu_body))
         response.raise_for_status()
         rich_menu_id = response.json().get('richMenuId')
         print(f"リッチメニューの骨組みを作成しました。ID: {rich_menu_id}")
 
-        upload_url = f"https://api-data.line.me/v2/bot/richmenu/{rich_menu_id}/content"
+        upload_url = f"{http_client.LINE_DATA_API_BASE_URL}/v2/bot/richmenu/{rich_menu_id}/content"
         headers_img = {"Authorization": f"Bearer {CHANNEL_ACCESS_TOKEN}", "Content-Type": "image/png"}
         with open(RICH_MENU_IMAGE_PATH, 'rb') as f:
-            response_img = requests.post(upload_url, headers=headers_img, data=f)
+            response_img = http_client.post(upload_url, headers=headers_img, data=f)
             response_img.raise_for_status()
         print("画像をアップロードしました。")
 
-        set_default_url = "https://api.line.me/v2/bot/user/all/richmenu/" + rich_menu_id
+        set_default_url = f"{http_client.LINE_API_BASE_URL}/v2/bot/user/all/richmenu/" + rich_menu_id
         headers_set = {"Authorization": f"Bearer {CHANNEL_ACCESS_TOKEN}"}
-        response_set = requests.post(set_default_url, headers=headers_set)
+        response_set = http_client.post(set_default_url, headers=headers_set)
         response_set.raise_for_status()
         print("デフォルトリッチメニューとして設定しました。")
 
     except requests.exceptions.RequestException as e:
-        print(f"エラーが発生しました: {e}\n応答内容: {e.response.text}")
+        print(f"エラーが発生しました: {e}")
+        if e.response is not None: print(f"応答内容: {e.response.text}")
     except Exception as e:
         print(f"予期せぬエラーが発生しました: {e}")
 
@@ -1,80 +1,152 @@
 import os
-import requests
-import json
-from datetime import datetime
+import zlib
+import queue
+import socket
+import argparse
+import threading
 from dotenv import load_dotenv
 import database
+import dispatcher
+import forecast
+import metrics
 
 load_dotenv()
 CHANNEL_ACCESS_TOKEN = os.environ.get("LINE_CHANNEL_ACCESS_TOKEN")
 OPENWEATHER_API_KEY = os.environ.get("OPENWEATHER_API_KEY")
 
-def get_open_meteo_forecast_message_dict(lat, lon, city_name):
-    api_url = f"https://api.open-meteo.com/v1/forecast?latitude={lat}&longitude={lon}&daily=weather_code,temperature_2m_max,temperature_2m_min,precipitation_probability_max&timezone=Asia%2FTokyo"
-    try:
-        response = requests.get(api_url)
-        response.raise_for_status()
-        data = response.json()
-        today = data["daily"]
-        date_str = datetime.strptime(today["time"][0], '%Y-%m-%d').strftime('%Y年%m月%d日')
-        temp_max = today["temperature_2m_max"][0]
-        temp_min = today["temperature_2m_min"][0]
-        pop = today["precipitation_probability_max"][0]
-        weather_codes = {0:"快晴",1:"晴れ",2:"一部曇",3:"曇り",45:"霧",48:"霧氷",51:"霧雨",53:"霧雨",55:"霧雨",56:"着氷性の霧雨",57:"着氷性の霧雨",61:"小雨",63:"雨",65:"大雨",66:"着氷性の雨",67:"着氷性の雨",71:"小雪",73:"雪",75:"大雪",77:"霧雪",80:"にわか雨",81:"にわか雨",82:"激しいにわか雨",85:"弱いしゅう雪",86:"強いしゅう雪",95:"雷雨",96:"雷雨と雹",99:"雷雨と雹"}
-        weather = weather_codes.get(today["weather_code"][0], "不明")
-        return {
-            "type": "flex", "altText": f"{city_name}の天気予報 (JMAデータ)",
-            "contents": { "type": "bubble", "direction": 'ltr',
-                "header": {"type": "box", "layout": "vertical", "contents": [{"type": "text", "text": "今日の天気予報", "weight": "bold", "size": "xl", "color": "#FFFFFF", "align": "center"}], "backgroundColor": "#5C6BC0", "paddingTop": "12px", "paddingBottom": "12px"},
-                "body": {"type": "box", "layout": "vertical", "spacing": "md", "contents": [
-                    {"type": "box", "layout": "vertical", "contents": [{"type": "text", "text": city_name, "size": "lg", "weight": "bold", "color": "#5C6BC0", "wrap": True}, {"type": "text", "text": date_str, "size": "sm", "color": "#AAAAAA"}]},
-                    {"type": "separator", "margin": "md"},
-                    {"type": "box", "layout": "vertical", "margin": "lg", "spacing": "sm", "contents": [
-                        {"type": "box", "layout": "baseline", "spacing": "sm", "contents": [{"type": "text", "text": "天気", "color": "#AAAAAA", "size": "sm", "flex": 2}, {"type": "text", "text": weather, "wrap": True, "color": "#666666", "size": "sm", "flex": 5}]},
-                        {"type": "box", "layout": "baseline", "spacing": "sm", "contents": [{"type": "text", "text": "最高気温", "color": "#AAAAAA", "size": "sm", "flex": 2}, {"type": "text", "text": f"{temp_max}°C", "wrap": True, "color": "#666666", "size": "sm", "flex": 5}]},
-                        {"type": "box", "layout": "baseline", "spacing": "sm", "contents": [{"type": "text", "text": "最低気温", "color": "#AAAAAA", "size": "sm", "flex": 2}, {"type": "text", "text": f"{temp_min}°C", "wrap": True, "color": "#666666", "size": "sm", "flex": 5}]},
-                        {"type": "box", "layout": "baseline", "spacing": "sm", "contents": [{"type": "text", "text": "降水確率", "color": "#AAAAAA", "size": "sm", "flex": 2}, {"type": "text", "text": f"{pop}%", "wrap": True, "color": "#666666", "size": "sm", "flex": 5}]}
-                    ]}
-                ]}
-            }
-        }
-    except Exception as e:
-        print(f"Open-Meteo API Error: {e}")
-        return {"type": "text", "text": "天気情報の取得に失敗しました。"}
-
-def push_to_line(user_id, messages):
-    headers = {"Content-Type": "application/json; charset=UTF-8", "Authorization": f"Bearer {CHANNEL_ACCESS_TOKEN}"}
-    body = {"to": user_id, "messages": messages}
-    try:
-        response = requests.post("https://api.line.me/v2/bot/message/push", headers=headers, data=json.dumps(body, ensure_ascii=False).encode('utf-8'))
-        response.raise_for_status()
-        print(f"ユーザー({user_id})への通知が成功しました。")
-    except requests.exceptions.RequestException as e:
-        print(f"ユーザー({user_id})へのLINE通知エラー: {e}")
-        if e.response: print(f"応答内容: {e.response.text}")
-
-def send_daily_forecasts():
-    print("デイリー通知の送信を開始します...")
-    database.init_db()
-    users = database.get_all_users_with_location()
-    
-    if not users:
-        print("通知対象のユーザーが見つかりませんでした。")
-    
+# 配信方式: "multicast"（同一内容のユーザーをまとめて送信）または "push"（1ユーザーずつ送信）
+DELIVERY_MODE = os.environ.get("NOTIFY_DELIVERY_MODE", "multicast")
+
+# DBからの読み込みを送信と並行して先読みしておくバッチ数
+PREFETCH_BATCHES = int(os.environ.get("NOTIFY_PREFETCH_BATCHES", "2"))
+_END = object()
+# --claim-jobs で引き受けたバッチを、他のワーカーが引き受け直せるようになるまでの秒数
+JOB_LEASE_SECONDS = int(os.environ.get("NOTIFY_JOB_LEASE", "600"))
+
+def prefetch(batches, depth=PREFETCH_BATCHES):
+    """ジェネレーターを別スレッドで先読みし、送信中にも次のバッチを読み込んでおくジェネレーター"""
+    buffer = queue.Queue(maxsize=depth)
+
+    def reader():
+        try:
+            for batch in batches:
+                buffer.put(batch)
+        except Exception as e:
+            buffer.put(e)
+        buffer.put(_END)
+
+    threading.Thread(target=reader, daemon=True).start()
+    while True:
+        item = buffer.get()
+        if item is _END:
+            return
+        if isinstance(item, Exception):
+            raise item
+        yield item
+
+def build_deliveries(users):
+    """ユーザーのバッチから (ユーザーID, メッセージリスト) の一覧を組み立てる関数
+    戻り値は (配信一覧, 地点セルの集合, Open-Meteoリクエスト数) のタプル。"""
+    # 同じグリッドセルに属するユーザーをまとめ、予報の取得はセルごとに1回だけにする
+    users_by_cell = {}
     for user in users:
         user_id, city_name, lat, lon = user
-        print(f"登録地「{city_name}」({user_id})の天気予報を送信中...")
-        
         if lat is not None and lon is not None:
-            forecast_message = get_open_meteo_forecast_message_dict(lat, lon, city_name)
-            push_to_line(user_id, [forecast_message])
+            users_by_cell.setdefault(forecast.get_grid_cell(lat, lon), []).append((user_id, city_name))
         else:
             print(f"「{city_name}」の座標がDBにないため、送信をスキップします。")
-            
-    print("デイリー通知の送信が完了しました。")
+
+    # 事前取得（python forecast.py prewarm）済みであれば、ここでOpen-Meteoへのリクエストは発生しない
+    forecasts, request_count = forecast.get_daily_forecasts(users_by_cell)
+
+    deliveries = []
+    for cell, cell_users in users_by_cell.items():
+        daily = forecasts.get(cell)
+        for user_id, city_name in cell_users:
+            if daily is not None:
+                forecast_message = forecast.build_forecast_message(daily, city_name)
+            else:
+                forecast_message = forecast.FETCH_FAILED_MESSAGE
+            deliveries.append((user_id, [forecast_message]))
+    return deliveries, set(users_by_cell), request_count
+
+def parse_shard(value):
+    """「i/N」形式の文字列を (i, N) に変換する関数"""
+    index, count = (int(part) for part in value.split("/"))
+    if not 0 <= index < count:
+        raise ValueError(f"シャードの指定が不正です: {value}")
+    return index, count
+
+def in_shard(user_id, shard):
+    """ユーザーIDのハッシュ値で、ユーザーが指定したシャードに属するかを判定する関数"""
+    index, count = shard
+    return zlib.crc32(user_id.encode('utf-8')) % count == index
+
+def iter_sharded_users(shard):
+    """静的シャード（--shard i/N）に属するユーザーを、バッチごとに順次返すジェネレーター"""
+    for users in database.iter_users_with_location():
+        batch = [user for user in users if in_shard(user[0], shard)]
+        if batch:
+            yield batch
+
+def process_claimed_jobs(run_id, worker_id, handle_batch):
+    """notification_jobsテーブルからバッチを引き受けて処理し、残りがなくなるまで繰り返す関数
+    停止したワーカーが引き受けたバッチは、有効期限（NOTIFY_JOB_LEASE秒）が切れると他のワーカーが引き受け直す。
+    バッチは最初に登録できたワーカーの読み込んだ範囲だけで作られ、隣り合うバッチの間に隙間はない。"""
+    if not database.has_notification_jobs(run_id):
+        database.create_notification_jobs(run_id, list(database.iter_user_id_ranges_with_location()))
+    while True:
+        job = database.claim_notification_job(run_id, worker_id, JOB_LEASE_SECONDS)
+        if job is None:
+            return
+        batch_no, after_user_id, last_user_id = job
+        print(f"バッチ{batch_no}（{after_user_id or '先頭'} より後 〜 {last_user_id or '末尾'}）を引き受けました。(ワーカー: {worker_id})")
+        handle_batch(database.get_users_with_location_in_range(after_user_id, last_user_id))
+        database.complete_notification_job(run_id, batch_no, worker_id)
+
+def send_daily_forecasts(run_id=None, shard=None, claim_jobs=False, worker_id=None):
+    # 同じ日に再実行した場合や、複数のワーカーで分担した場合でも、送信済みのユーザーには送らない
+    run_id = run_id or f"daily-{forecast.today_jst().isoformat()}"
+    worker_id = worker_id or f"{socket.gethostname()}-{os.getpid()}"
+    print(f"デイリー通知の送信を開始します... (run_id: {run_id}, ワーカー: {worker_id})")
+    database.auto_migrate()
+
+    stats = dispatcher.DispatchStats()
+    counts = {"users": 0, "requests": 0}
+    # 複数のバッチにまたがる地点セルを重複して数えないよう、実行全体のセルを集合で持つ
+    cells = set()
+
+    def handle_batch(users):
+        deliveries, batch_cells, batch_requests = build_deliveries(users)
+        counts["users"] += len(users)
+        cells.update(batch_cells)
+        counts["requests"] += batch_requests
+        dispatcher.dispatch(run_id, deliveries, mode=DELIVERY_MODE, stats=stats)
+
+    if claim_jobs:
+        process_claimed_jobs(run_id, worker_id, handle_batch)
+    else:
+        # ユーザーはバッチごとに読み込み、読み込みの完了を待たずに先頭のバッチから送信する
+        batches = iter_sharded_users(shard) if shard else database.iter_users_with_location()
+        for users in prefetch(batches):
+            handle_batch(users)
+
+    if not counts["users"]:
+        print("通知対象のユーザーが見つかりませんでした。")
+    stats.report(run_id)
+    metrics.print_summary(run_id)
+    unconfirmed = database.count_unconfirmed_deliveries(run_id)
+    if unconfirmed:
+        print(f"送信中のまま完了が記録されていないユーザーが{unconfirmed}人います（{dispatcher.DISPATCH_CLAIM_LEASE}秒経過後の実行で、同じリトライキーで送り直します）。")
+    print(f"デイリー通知の送信が完了しました。(ユーザー数: {counts['users']}, 地点セル数: {len(cells)}, Open-Meteoリクエスト数: {counts['requests']})")
 
 if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description="登録地の天気予報を全ユーザーに送信します。")
+    arg_parser.add_argument("--shard", type=parse_shard, help="user_idのハッシュで分割したうち、このワーカーが担当するシャード（例: 0/4）")
+    arg_parser.add_argument("--claim-jobs", action="store_true", help="notification_jobsテーブルからバッチを引き受けて、他のワーカーと分担する")
+    arg_parser.add_argument("--worker-id", help="ワーカーの識別子（省略時はホスト名とプロセスID）")
+    args = arg_parser.parse_args()
     if not all([CHANNEL_ACCESS_TOKEN, OPENWEATHER_API_KEY]):
         print("エラー: .envファイルに必要なキーが設定されていません。")
     else:
-        send_daily_forecasts()
+        send_daily_forecasts(shard=args.shard, claim_jobs=args.claim_jobs, worker_id=args.worker_id)
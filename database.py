@@ -1,5 +1,9 @@
 import os
-from sqlalchemy import create_engine, text
+import sys
+import time
+import threading
+from sqlalchemy import create_engine, text, bindparam, inspect
+import metrics
 
 # Renderの環境変数からデータベースURLを取得
 DATABASE_URL = os.environ.get('DATABASE_URL')
@@ -8,15 +12,50 @@ DATABASE_URL = os.environ.get('DATABASE_URL')
 if DATABASE_URL and DATABASE_URL.startswith("postgres://"):
     DATABASE_URL = DATABASE_URL.replace("postgres://", "postgresql+psycopg2://", 1)
 
-engine = create_engine(DATABASE_URL) if DATABASE_URL else None
+# エンジン（とDBドライバーの読み込み）は、最初にDBを使うときに作成する
+_engine = None
+_engine_lock = threading.Lock()
 
+# 起動時（アプリの読み込み時・定期実行の開始時）にテーブルを作成するかどうか。
+# 無効の場合は、デプロイ時に python database.py migrate を実行する
+AUTO_MIGRATE = os.environ.get("AUTO_MIGRATE", "0") == "1"
+
+# 定期配信でユーザーを読み込む際の1回あたりの件数
+USER_BATCH_SIZE = int(os.environ.get('USER_BATCH_SIZE', '1000'))
+
+def get_engine():
+    """SQLAlchemyのエンジンを返す関数（最初に呼ばれたときに作成する。DATABASE_URLがなければNone）"""
+    global _engine
+    if _engine is None and DATABASE_URL:
+        with _engine_lock:
+            if _engine is None:
+                _engine = create_engine(DATABASE_URL)
+    return _engine
+
+def dispose_engine():
+    """fork前に作成したコネクションプールを、fork後の子プロセスで使わないようにする関数（gunicornのpost_forkから呼ぶ）"""
+    if _engine is not None:
+        _engine.dispose(close=False)
+
+def __getattr__(name):
+    # database.engine での参照用
+    if name == "engine":
+        return get_engine()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+def auto_migrate():
+    """AUTO_MIGRATEが有効な場合だけ、テーブルを作成する関数"""
+    if AUTO_MIGRATE:
+        init_db()
+
+@metrics.instrument("database")
 def init_db():
     """データベースとテーブルを初期化（なければ作成）する関数"""
-    if not engine:
+    if not get_engine():
         print("データベースURLが設定されていないため、初期化をスキップします。")
         return
     
-    with engine.connect() as connection:
+    with get_engine().connect() as connection:
         connection.execute(text('''
             CREATE TABLE IF NOT EXISTS users (
                 user_id TEXT PRIMARY KEY,
@@ -26,29 +65,123 @@ def init_db():
                 lon REAL   -- 経度を保存
             )
         '''))
+        # 「地点登録済み」「地点未登録」のユーザーをuser_id順に読み込むための部分インデックス
+        connection.execute(text('''
+            CREATE INDEX IF NOT EXISTS idx_users_with_location ON users (user_id)
+            WHERE city_name IS NOT NULL AND lat IS NOT NULL AND lon IS NOT NULL
+        '''))
+        connection.execute(text('''
+            CREATE INDEX IF NOT EXISTS idx_users_without_location ON users (user_id)
+            WHERE city_name IS NULL OR lat IS NULL OR lon IS NULL
+        '''))
+        # 定期配信ジョブの送信済みユーザーを記録するチェックポイント
+        connection.execute(text('''
+            CREATE TABLE IF NOT EXISTS delivery_checkpoints (
+                run_id TEXT NOT NULL,
+                user_id TEXT NOT NULL,
+                status TEXT NOT NULL DEFAULT 'delivered',  -- 'sending'（送信中）または 'delivered'（送信済み）
+                claim_token TEXT,                         -- 送信を引き受けたワーカーの識別子
+                delivered_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                retry_key TEXT,                           -- 送信に使うX-Line-Retry-Key（delivery_requestsのキー）
+                claimed_at REAL,                          -- 送信を引き受けた時刻（UNIX時刻）
+                PRIMARY KEY (run_id, user_id)
+            )
+        '''))
+        # retry_key, claimed_at を追加する前に作成されたテーブルへの列の追加
+        existing_columns = {column["name"] for column in inspect(connection).get_columns("delivery_checkpoints")}
+        for column, column_type in (("retry_key", "TEXT"), ("claimed_at", "REAL")):
+            if column not in existing_columns:
+                connection.execute(text(f"ALTER TABLE delivery_checkpoints ADD COLUMN {column} {column_type}"))
+        connection.execute(text('''
+            CREATE INDEX IF NOT EXISTS idx_delivery_checkpoints_retry_key ON delivery_checkpoints (retry_key)
+        '''))
+        # 送信中のリクエストの内容。送信途中で停止したワーカーの分を、他のワーカーが同じリトライキーで送り直すために使う
+        connection.execute(text('''
+            CREATE TABLE IF NOT EXISTS delivery_requests (
+                retry_key TEXT PRIMARY KEY,
+                run_id TEXT NOT NULL,
+                url TEXT NOT NULL,
+                body TEXT NOT NULL,         -- 送信するJSON（宛先を含む）
+                claim_token TEXT NOT NULL,  -- 送信を引き受けたワーカーの識別子
+                claimed_at REAL NOT NULL    -- 送信を引き受けた時刻（UNIX時刻）
+            )
+        '''))
+        # 複数ワーカーで定期配信を分担するための、ユーザーIDの範囲ごとのジョブ
+        connection.execute(text('''
+            CREATE TABLE IF NOT EXISTS notification_jobs (
+                run_id TEXT NOT NULL,
+                batch_no INTEGER NOT NULL,
+                first_user_id TEXT NOT NULL,
+                last_user_id TEXT NOT NULL,
+                status TEXT NOT NULL DEFAULT 'pending',  -- 'pending' / 'claimed' / 'done'
+                claimed_by TEXT,
+                lease_expires_at REAL,  -- 引き受けの有効期限（UNIX時刻）
+                PRIMARY KEY (run_id, batch_no)
+            )
+        '''))
+        # 地点未登録ユーザーへの、地点登録のお願いの送信履歴（次に送ってよい時刻がNULLなら、もう送らない）
+        connection.execute(text('''
+            CREATE TABLE IF NOT EXISTS prompt_ledger (
+                user_id TEXT PRIMARY KEY,
+                prompt_count INTEGER NOT NULL,
+                last_prompted_at REAL NOT NULL,  -- 最後に送った時刻（UNIX時刻）
+                next_prompt_at REAL              -- 次に送ってよい時刻（UNIX時刻）
+            )
+        '''))
+        # 地名から座標へのジオコーディング結果のキャッシュ（lat, lonがNULLなら「見つからなかった」）
+        connection.execute(text('''
+            CREATE TABLE IF NOT EXISTS geocode_cache (
+                name_key TEXT PRIMARY KEY,
+                lat REAL,
+                lon REAL,
+                expires_at REAL NOT NULL  -- 有効期限（UNIX時刻）
+            )
+        '''))
+        # 非同期処理待ちのWebhookイベント（durableモード用）。1行が1回の配信で、payloadはイベントのJSON配列
+        connection.execute(text('''
+            CREATE TABLE IF NOT EXISTS webhook_events (
+                event_id TEXT PRIMARY KEY,
+                payload TEXT NOT NULL,
+                enqueued_at REAL NOT NULL,  -- 受信時刻（UNIX時刻）
+                claimed_at REAL NOT NULL    -- 処理を引き受けた時刻（UNIX時刻）
+            )
+        '''))
+        # グリッドセル・日付ごとの天気予報（Open-Meteoの日次予報データのJSON）のキャッシュ
+        connection.execute(text('''
+            CREATE TABLE IF NOT EXISTS forecast_cache (
+                cell_key TEXT NOT NULL,
+                forecast_date TEXT NOT NULL,
+                payload TEXT NOT NULL,
+                fetched_at REAL NOT NULL,  -- 取得時刻（UNIX時刻）
+                PRIMARY KEY (cell_key, forecast_date)
+            )
+        '''))
         connection.commit()
 
+@metrics.instrument("database")
 def set_user_state(user_id, state):
     """ユーザーの状態を設定または更新する関数"""
-    if not engine: return
-    with engine.connect() as connection:
+    if not get_engine(): return
+    with get_engine().connect() as connection:
         connection.execute(text("""
             INSERT INTO users (user_id, state) VALUES (:user_id, :state)
             ON CONFLICT(user_id) DO UPDATE SET state = :state
         """), {"user_id": user_id, "state": state})
         connection.commit()
 
+@metrics.instrument("database")
 def get_user_state(user_id):
     """ユーザーの状態を取得する関数"""
-    if not engine: return None
-    with engine.connect() as connection:
+    if not get_engine(): return None
+    with get_engine().connect() as connection:
         result = connection.execute(text("SELECT state FROM users WHERE user_id = :user_id"), {"user_id": user_id}).fetchone()
         return result[0] if result else None
 
+@metrics.instrument("database")
 def set_user_location(user_id, city_name, lat, lon):
     """ユーザーの登録地と、状態を'normal'にリセットする関数"""
-    if not engine: return
-    with engine.connect() as connection:
+    if not get_engine(): return
+    with get_engine().connect() as connection:
         # 地点情報と、状態を'normal'にリセット
         connection.execute(text("""
             INSERT INTO users (user_id, state, city_name, lat, lon) VALUES (:user_id, 'normal', :city_name, :lat, :lon)
@@ -57,23 +190,467 @@ def set_user_location(user_id, city_name, lat, lon):
         """), {"user_id": user_id, "city_name": city_name, "lat": lat, "lon": lon})
         connection.commit()
 
+@metrics.instrument("database")
+def get_user_states(user_ids):
+    """複数ユーザーの状態を1回のクエリでまとめて取得する関数（戻り値は {ユーザーID: 状態}）"""
+    if not get_engine() or not user_ids: return {}
+    with get_engine().connect() as connection:
+        result = connection.execute(text("""
+            SELECT user_id, state FROM users WHERE user_id IN :user_ids
+        """).bindparams(bindparam("user_ids", expanding=True)), {"user_ids": list(user_ids)}).fetchall()
+        return {user_id: state for user_id, state in result}
+
+@metrics.instrument("database")
+def set_user_states_and_locations(states, locations):
+    """複数ユーザーの状態 {ユーザーID: 状態} と登録地 {ユーザーID: (地名, 緯度, 経度)} を、まとめて書き込む関数
+    登録地を先に書き込み（状態は'normal'になる）、その後に状態を書き込む。"""
+    if not get_engine() or not (states or locations): return
+    with get_engine().connect() as connection:
+        if locations:
+            connection.execute(text("""
+                INSERT INTO users (user_id, state, city_name, lat, lon) VALUES (:user_id, 'normal', :city_name, :lat, :lon)
+                ON CONFLICT(user_id) DO UPDATE SET
+                    state = 'normal', city_name = :city_name, lat = :lat, lon = :lon
+            """), [{"user_id": user_id, "city_name": city_name, "lat": lat, "lon": lon} for user_id, (city_name, lat, lon) in locations.items()])
+        if states:
+            connection.execute(text("""
+                INSERT INTO users (user_id, state) VALUES (:user_id, :state)
+                ON CONFLICT(user_id) DO UPDATE SET state = :state
+            """), [{"user_id": user_id, "state": state} for user_id, state in states.items()])
+        connection.commit()
+
+def is_postgres():
+    """PostgreSQLに接続しているかどうか"""
+    return bool(DATABASE_URL) and DATABASE_URL.startswith("postgresql")
+
+@metrics.instrument("database")
+def notify(channel, payloads):
+    """PostgreSQLのNOTIFYで、チャンネルを購読している他のプロセスにメッセージを送る関数"""
+    if not is_postgres() or not payloads: return
+    with get_engine().connect() as connection:
+        connection.execute(text("SELECT pg_notify(:channel, :payload)"), [{"channel": channel, "payload": payload} for payload in payloads])
+        connection.commit()
+
+def open_listen_connection(channel):
+    """チャンネルをLISTENした、コネクションプールから切り離したDBAPI(psycopg2)接続を返す関数"""
+    connection = get_engine().raw_connection()
+    connection.detach()
+    dbapi_connection = connection.driver_connection
+    dbapi_connection.autocommit = True
+    with dbapi_connection.cursor() as cursor:
+        cursor.execute(f'LISTEN "{channel}"')
+    return dbapi_connection
+
+@metrics.instrument("database")
 def get_user_location(user_id):
     """ユーザーの登録地（地名、緯度、経度）を取得する関数"""
-    if not engine: return (None, None, None)
-    with engine.connect() as connection:
+    if not get_engine(): return (None, None, None)
+    with get_engine().connect() as connection:
         result = connection.execute(text("SELECT city_name, lat, lon FROM users WHERE user_id = :user_id"), {"user_id": user_id}).fetchone()
         return result if result else (None, None, None)
 
+@metrics.instrument("database")
 def get_all_users_with_location():
     """登録地がある全ユーザーの情報を取得する関数（自動通知用）"""
-    if not engine: return []
-    with engine.connect() as connection:
+    if not get_engine(): return []
+    with get_engine().connect() as connection:
         result = connection.execute(text("SELECT user_id, city_name, lat, lon FROM users WHERE city_name IS NOT NULL AND lat IS NOT NULL AND lon IS NOT NULL")).fetchall()
         return result
 
+@metrics.instrument("database")
 def get_users_without_location():
     """地点情報が登録されていない（city_name, lat, lonのいずれかがNULLの）全ユーザーの情報を取得する関数"""
-    if not engine: return []
-    with engine.connect() as connection:
+    if not get_engine(): return []
+    with get_engine().connect() as connection:
         result = connection.execute(text("SELECT user_id FROM users WHERE city_name IS NULL OR lat IS NULL OR lon IS NULL")).fetchall()
-        return [row[0] for row in result]
\ No newline at end of file
+        return [row[0] for row in result]
+
+def iter_users_with_location(batch_size=None):
+    """登録地があるユーザーを、user_id順にbatch_size件ずつのリストで順次返すジェネレーター（自動通知用）
+    user_idによるキーセットページングのため、全件をメモリに読み込まない。"""
+    if not get_engine(): return
+    batch_size = batch_size or USER_BATCH_SIZE
+    last_user_id = ""
+    while True:
+        # ジェネレーターのため、1ページ分の読み込みごとに計測する
+        with metrics.timed("database", "iter_users_with_location"), get_engine().connect() as connection:
+            result = connection.execute(text("""
+                SELECT user_id, city_name, lat, lon FROM users
+                WHERE city_name IS NOT NULL AND lat IS NOT NULL AND lon IS NOT NULL AND user_id > :last_user_id
+                ORDER BY user_id LIMIT :batch_size
+            """), {"last_user_id": last_user_id, "batch_size": batch_size}).fetchall()
+        if not result:
+            return
+        yield result
+        last_user_id = result[-1][0]
+
+def iter_users_due_for_prompt(now, batch_size=None):
+    """地点未登録で、地点登録のお願いを送る時期が来ているユーザーを、
+    user_id順に (ユーザーID, これまでに送った回数) のbatch_size件ずつのリストで順次返すジェネレーター
+    1ページずつ送信の直前に読み込むため、実行中に地点を登録したユーザーはまだ読み込んでいなければ対象から外れる。"""
+    if not get_engine(): return
+    batch_size = batch_size or USER_BATCH_SIZE
+    last_user_id = ""
+    while True:
+        with metrics.timed("database", "iter_users_due_for_prompt"), get_engine().connect() as connection:
+            result = connection.execute(text("""
+                SELECT u.user_id, COALESCE(p.prompt_count, 0) FROM users u
+                LEFT JOIN prompt_ledger p ON p.user_id = u.user_id
+                WHERE (u.city_name IS NULL OR u.lat IS NULL OR u.lon IS NULL) AND u.user_id > :last_user_id
+                    AND (p.user_id IS NULL OR p.next_prompt_at <= :now)
+                ORDER BY u.user_id LIMIT :batch_size
+            """), {"last_user_id": last_user_id, "now": now, "batch_size": batch_size}).fetchall()
+        if not result:
+            return
+        yield [(user_id, prompt_count) for user_id, prompt_count in result]
+        last_user_id = result[-1][0]
+
+@metrics.instrument("database")
+def get_prompt_counts(user_ids):
+    """指定したユーザーに地点登録のお願いを送った回数を取得する関数（戻り値は {ユーザーID: 回数}。送っていなければ0）"""
+    if not get_engine() or not user_ids: return {}
+    with get_engine().connect() as connection:
+        result = connection.execute(text("""
+            SELECT user_id, prompt_count FROM prompt_ledger WHERE user_id IN :user_ids
+        """).bindparams(bindparam("user_ids", expanding=True)), {"user_ids": list(user_ids)}).fetchall()
+    counts = dict.fromkeys(user_ids, 0)
+    counts.update({user_id: prompt_count for user_id, prompt_count in result})
+    return counts
+
+@metrics.instrument("database")
+def record_prompts(entries):
+    """地点登録のお願いを送ったことを記録する関数（entriesは (ユーザーID, 送った回数, 送った時刻, 次に送ってよい時刻) のリスト）"""
+    if not get_engine() or not entries: return
+    with get_engine().connect() as connection:
+        connection.execute(text("""
+            INSERT INTO prompt_ledger (user_id, prompt_count, last_prompted_at, next_prompt_at)
+            VALUES (:user_id, :prompt_count, :last_prompted_at, :next_prompt_at)
+            ON CONFLICT(user_id) DO UPDATE SET
+                prompt_count = :prompt_count, last_prompted_at = :last_prompted_at, next_prompt_at = :next_prompt_at
+        """), [
+            {"user_id": user_id, "prompt_count": prompt_count, "last_prompted_at": prompted_at, "next_prompt_at": next_prompt_at}
+            for user_id, prompt_count, prompted_at, next_prompt_at in entries
+        ])
+        connection.commit()
+
+@metrics.instrument("database")
+def get_delivered_user_ids(run_id, user_ids):
+    """指定した配信ジョブで、指定したユーザーのうち送信済みのユーザーIDの集合を取得する関数"""
+    if not get_engine() or not user_ids: return set()
+    with get_engine().connect() as connection:
+        result = connection.execute(text("""
+            SELECT user_id FROM delivery_checkpoints WHERE run_id = :run_id AND user_id IN :user_ids
+        """).bindparams(bindparam("user_ids", expanding=True)), {"run_id": run_id, "user_ids": list(user_ids)}).fetchall()
+        return {row[0] for row in result}
+
+@metrics.instrument("database")
+def claim_deliveries(run_id, user_ids, claim_token, retry_key=None):
+    """指定した配信ジョブで、まだ誰も送信していないユーザーの送信を引き受ける関数
+    (run_id, user_id) の主キーにより、同じユーザーを複数のワーカーが引き受けることはない。
+    retry_keyは、このユーザーたちへの送信に使うX-Line-Retry-Key。
+    戻り値は引き受けられたユーザーIDの集合（DB未設定時は全員を引き受けたものとみなす）。"""
+    if not get_engine() or not user_ids: return set(user_ids)
+    now = time.time()
+    with get_engine().connect() as connection:
+        connection.execute(text("""
+            INSERT INTO delivery_checkpoints (run_id, user_id, status, claim_token, retry_key, claimed_at)
+            VALUES (:run_id, :user_id, 'sending', :claim_token, :retry_key, :claimed_at)
+            ON CONFLICT(run_id, user_id) DO NOTHING
+        """), [{"run_id": run_id, "user_id": user_id, "claim_token": claim_token, "retry_key": retry_key, "claimed_at": now} for user_id in user_ids])
+        connection.commit()
+        result = connection.execute(text("""
+            SELECT user_id FROM delivery_checkpoints
+            WHERE run_id = :run_id AND claim_token = :claim_token AND status = 'sending' AND user_id IN :user_ids
+        """).bindparams(bindparam("user_ids", expanding=True)), {"run_id": run_id, "claim_token": claim_token, "user_ids": list(user_ids)}).fetchall()
+        return {row[0] for row in result}
+
+@metrics.instrument("database")
+def save_delivery_request(retry_key, run_id, url, body, claim_token):
+    """送信する直前に、リクエストの内容をリトライキーとともに保存する関数（送信途中で停止した場合の送り直し用）"""
+    if not get_engine(): return
+    with get_engine().connect() as connection:
+        connection.execute(text("""
+            INSERT INTO delivery_requests (retry_key, run_id, url, body, claim_token, claimed_at)
+            VALUES (:retry_key, :run_id, :url, :body, :claim_token, :claimed_at)
+        """), {"retry_key": retry_key, "run_id": run_id, "url": url, "body": body, "claim_token": claim_token, "claimed_at": time.time()})
+        connection.commit()
+
+@metrics.instrument("database")
+def take_over_stale_deliveries(run_id, user_ids, claim_token, claimed_before):
+    """指定したユーザーのうち、claimed_before より前に引き受けられたまま送信中になっているものを引き継ぐ関数
+    リクエストの内容が保存されているものは、その宛先全員の引き受けをclaim_tokenに移し、
+    戻り値の [(リトライキー, URL, 本文, 宛先ユーザーIDのリスト)] として返す（同じリトライキーで送り直すため）。
+    リクエストの保存前に停止したもの（LINEには送られていない）は、引き受けを取り消して通常どおり送信できるようにする。"""
+    if not get_engine() or not user_ids: return []
+    params = {"run_id": run_id, "user_ids": list(user_ids), "claim_token": claim_token, "claimed_before": claimed_before}
+    with get_engine().connect() as connection:
+        connection.execute(text("""
+            DELETE FROM delivery_checkpoints
+            WHERE run_id = :run_id AND user_id IN :user_ids AND status = 'sending' AND retry_key IS NOT NULL
+                AND claimed_at < :claimed_before
+                AND retry_key NOT IN (SELECT retry_key FROM delivery_requests WHERE run_id = :run_id)
+        """).bindparams(bindparam("user_ids", expanding=True)), params)
+        # claimed_atを条件に更新するため、複数のワーカーが同じリクエストを引き継ぐことはない
+        requests = connection.execute(text("""
+            UPDATE delivery_requests SET claim_token = :claim_token, claimed_at = :now
+            WHERE run_id = :run_id AND claimed_at < :claimed_before AND retry_key IN (
+                SELECT retry_key FROM delivery_checkpoints
+                WHERE run_id = :run_id AND user_id IN :user_ids AND status = 'sending' AND retry_key IS NOT NULL
+            )
+            RETURNING retry_key, url, body
+        """).bindparams(bindparam("user_ids", expanding=True)), {**params, "now": time.time()}).fetchall()
+        taken = []
+        for retry_key, url, body in requests:
+            connection.execute(text("""
+                UPDATE delivery_checkpoints SET claim_token = :claim_token
+                WHERE run_id = :run_id AND retry_key = :retry_key AND status = 'sending'
+            """), {"run_id": run_id, "retry_key": retry_key, "claim_token": claim_token})
+            recipients = connection.execute(text("""
+                SELECT user_id FROM delivery_checkpoints WHERE run_id = :run_id AND retry_key = :retry_key AND status = 'sending'
+            """), {"run_id": run_id, "retry_key": retry_key}).fetchall()
+            taken.append((retry_key, url, body, [row[0] for row in recipients]))
+        connection.commit()
+        return taken
+
+@metrics.instrument("database")
+def mark_users_delivered(run_id, user_ids, claim_token, retry_key=None):
+    """引き受けたユーザーへの送信が完了したことを記録する関数（retry_keyを渡すと、保存したリクエストも削除する）"""
+    if not get_engine() or not user_ids: return
+    with get_engine().connect() as connection:
+        connection.execute(text("""
+            UPDATE delivery_checkpoints SET status = 'delivered', delivered_at = CURRENT_TIMESTAMP
+            WHERE run_id = :run_id AND user_id = :user_id AND claim_token = :claim_token
+        """), [{"run_id": run_id, "user_id": user_id, "claim_token": claim_token} for user_id in user_ids])
+        if retry_key:
+            connection.execute(text("DELETE FROM delivery_requests WHERE retry_key = :retry_key AND claim_token = :claim_token"), {"retry_key": retry_key, "claim_token": claim_token})
+        connection.commit()
+
+@metrics.instrument("database")
+def release_deliveries(run_id, user_ids, claim_token, retry_key=None):
+    """送信に失敗したユーザーの引き受けを取り消し、再実行時に送信し直せるようにする関数（retry_keyを渡すと、保存したリクエストも削除する）"""
+    if not get_engine() or not user_ids: return
+    with get_engine().connect() as connection:
+        connection.execute(text("""
+            DELETE FROM delivery_checkpoints
+            WHERE run_id = :run_id AND user_id = :user_id AND claim_token = :claim_token AND status = 'sending'
+        """), [{"run_id": run_id, "user_id": user_id, "claim_token": claim_token} for user_id in user_ids])
+        if retry_key:
+            connection.execute(text("DELETE FROM delivery_requests WHERE retry_key = :retry_key AND claim_token = :claim_token"), {"retry_key": retry_key, "claim_token": claim_token})
+        connection.commit()
+
+@metrics.instrument("database")
+def count_unconfirmed_deliveries(run_id):
+    """送信中のまま完了が記録されていない（送信途中でワーカーが停止した可能性がある）ユーザー数を取得する関数"""
+    if not get_engine(): return 0
+    with get_engine().connect() as connection:
+        return connection.execute(text("SELECT COUNT(*) FROM delivery_checkpoints WHERE run_id = :run_id AND status = 'sending'"), {"run_id": run_id}).scalar()
+
+def iter_user_id_ranges_with_location(batch_size=None):
+    """登録地があるユーザーを、user_id順にbatch_size件ずつ区切った (先頭のuser_id, 末尾のuser_id) を順次返すジェネレーター"""
+    if not get_engine(): return
+    batch_size = batch_size or USER_BATCH_SIZE
+    last_user_id = ""
+    while True:
+        with metrics.timed("database", "iter_user_id_ranges_with_location"), get_engine().connect() as connection:
+            result = connection.execute(text("""
+                SELECT user_id FROM users
+                WHERE city_name IS NOT NULL AND lat IS NOT NULL AND lon IS NOT NULL AND user_id > :last_user_id
+                ORDER BY user_id LIMIT :batch_size
+            """), {"last_user_id": last_user_id, "batch_size": batch_size}).fetchall()
+        if not result:
+            return
+        yield (result[0][0], result[-1][0])
+        last_user_id = result[-1][0]
+
+@metrics.instrument("database")
+def get_users_with_location_in_range(after_user_id, last_user_id):
+    """user_idが after_user_id より大きく last_user_id 以下の、登録地があるユーザーの情報を取得する関数（last_user_idがNoneなら上限なし）"""
+    if not get_engine(): return []
+    upper_clause = "AND user_id <= :last_user_id" if last_user_id is not None else ""
+    with get_engine().connect() as connection:
+        result = connection.execute(text(f"""
+            SELECT user_id, city_name, lat, lon FROM users
+            WHERE city_name IS NOT NULL AND lat IS NOT NULL AND lon IS NOT NULL AND user_id > :after_user_id {upper_clause}
+            ORDER BY user_id
+        """), {"after_user_id": after_user_id, "last_user_id": last_user_id}).fetchall()
+        return result
+
+@metrics.instrument("database")
+def create_notification_jobs(run_id, ranges):
+    """定期配信のジョブ (先頭のuser_id, 末尾のuser_id) を登録する関数
+    複数のワーカーが同時に登録しようとしても、バッチ0を最初に登録できたワーカーだけが、全バッチを1つのトランザクションで登録する
+    （別々に読み込んだ範囲のバッチが混ざって、どのバッチにも含まれないユーザーができないようにする）。
+    登録した場合はTrue、他のワーカーが登録済みの場合はFalseを返す。"""
+    if not get_engine() or not ranges: return False
+    rows = [{"run_id": run_id, "batch_no": i, "first_user_id": first, "last_user_id": last} for i, (first, last) in enumerate(ranges)]
+    insert = text("""
+        INSERT INTO notification_jobs (run_id, batch_no, first_user_id, last_user_id) VALUES (:run_id, :batch_no, :first_user_id, :last_user_id)
+        ON CONFLICT(run_id, batch_no) DO NOTHING
+    """)
+    with get_engine().connect() as connection:
+        # 他のワーカーがバッチ0を登録中であれば、そのトランザクションの終了を待ってから競合する
+        if connection.execute(insert, rows[0]).rowcount == 0:
+            connection.rollback()
+            return False
+        if rows[1:]:
+            connection.execute(insert, rows[1:])
+        connection.commit()
+        return True
+
+@metrics.instrument("database")
+def has_notification_jobs(run_id):
+    """指定した配信ジョブのバッチが登録済みかどうかを返す関数"""
+    if not get_engine(): return False
+    with get_engine().connect() as connection:
+        return connection.execute(text("SELECT 1 FROM notification_jobs WHERE run_id = :run_id LIMIT 1"), {"run_id": run_id}).fetchone() is not None
+
+@metrics.instrument("database")
+def claim_notification_job(run_id, worker_id, lease_seconds):
+    """未処理のジョブ（または引き受けの有効期限が切れたジョブ）を1件引き受ける関数
+    PostgreSQLでは FOR UPDATE SKIP LOCKED により、複数のワーカーが同じジョブを待たずに別々のジョブを取る。
+    バッチの範囲は、前のバッチの末尾のuser_idより大きく、このバッチの末尾のuser_id以下（最後のバッチは上限なし）とし、
+    ジョブの登録後に地点を登録したユーザーも、いずれかのバッチに含まれるようにする。
+    戻り値は (バッチ番号, 前のバッチの末尾のuser_id（最初のバッチは空文字）, 末尾のuser_id（最後のバッチはNone）)、残りがなければNone。"""
+    if not get_engine(): return None
+    lock_clause = "FOR UPDATE SKIP LOCKED" if get_engine().dialect.name == "postgresql" else ""
+    now = time.time()
+    with get_engine().connect() as connection:
+        result = connection.execute(text(f"""
+            UPDATE notification_jobs SET status = 'claimed', claimed_by = :worker_id, lease_expires_at = :lease_expires_at
+            WHERE run_id = :run_id AND batch_no = (
+                SELECT batch_no FROM notification_jobs
+                WHERE run_id = :run_id AND (status = 'pending' OR (status = 'claimed' AND lease_expires_at < :now))
+                ORDER BY batch_no LIMIT 1
+                {lock_clause}
+            )
+            RETURNING batch_no, last_user_id
+        """), {"run_id": run_id, "worker_id": worker_id, "lease_expires_at": now + lease_seconds, "now": now}).fetchone()
+        if result is None:
+            connection.commit()
+            return None
+        batch_no, last_user_id = result
+        after_user_id, last_batch_no = connection.execute(text("""
+            SELECT
+                (SELECT last_user_id FROM notification_jobs WHERE run_id = :run_id AND batch_no = :batch_no - 1),
+                (SELECT MAX(batch_no) FROM notification_jobs WHERE run_id = :run_id)
+        """), {"run_id": run_id, "batch_no": batch_no}).fetchone()
+        connection.commit()
+        return batch_no, after_user_id or "", None if batch_no == last_batch_no else last_user_id
+
+@metrics.instrument("database")
+def complete_notification_job(run_id, batch_no, worker_id):
+    """引き受けたジョブの完了を記録する関数"""
+    if not get_engine(): return
+    with get_engine().connect() as connection:
+        connection.execute(text("""
+            UPDATE notification_jobs SET status = 'done'
+            WHERE run_id = :run_id AND batch_no = :batch_no AND claimed_by = :worker_id
+        """), {"run_id": run_id, "batch_no": batch_no, "worker_id": worker_id})
+        connection.commit()
+
+@metrics.instrument("database")
+def get_geocode_cache(name_key):
+    """ジオコーディングキャッシュを参照する関数
+    戻り値は (キャッシュの有無, 座標の辞書またはNone, 有効期限) のタプル。"""
+    if not get_engine(): return (False, None, None)
+    with get_engine().connect() as connection:
+        result = connection.execute(text("SELECT lat, lon, expires_at FROM geocode_cache WHERE name_key = :name_key AND expires_at > :now"), {"name_key": name_key, "now": time.time()}).fetchone()
+        if not result:
+            return (False, None, None)
+        lat, lon, expires_at = result
+        coords = {"lat": lat, "lon": lon} if lat is not None and lon is not None else None
+        return (True, coords, expires_at)
+
+@metrics.instrument("database")
+def set_geocode_cache(name_keys, coords, expires_at):
+    """ジオコーディング結果（見つからなかった場合はNone）をキャッシュに保存する関数"""
+    if not get_engine(): return
+    lat, lon = (coords["lat"], coords["lon"]) if coords else (None, None)
+    with get_engine().connect() as connection:
+        connection.execute(text("""
+            INSERT INTO geocode_cache (name_key, lat, lon, expires_at) VALUES (:name_key, :lat, :lon, :expires_at)
+            ON CONFLICT(name_key) DO UPDATE SET lat = :lat, lon = :lon, expires_at = :expires_at
+        """), [{"name_key": name_key, "lat": lat, "lon": lon, "expires_at": expires_at} for name_key in name_keys])
+        connection.commit()
+
+@metrics.instrument("database")
+def save_webhook_events(events):
+    """処理待ちのWebhookの配信 (配信ID, イベントのJSON配列, 受信時刻) を保存する関数"""
+    if not get_engine() or not events: return
+    with get_engine().connect() as connection:
+        connection.execute(text("""
+            INSERT INTO webhook_events (event_id, payload, enqueued_at, claimed_at) VALUES (:event_id, :payload, :enqueued_at, :enqueued_at)
+        """), [{"event_id": event_id, "payload": payload, "enqueued_at": enqueued_at} for event_id, payload, enqueued_at in events])
+        connection.commit()
+
+@metrics.instrument("database")
+def delete_webhook_event(event_id):
+    """処理が終わったWebhookイベントを削除する関数"""
+    if not get_engine(): return
+    with get_engine().connect() as connection:
+        connection.execute(text("DELETE FROM webhook_events WHERE event_id = :event_id"), {"event_id": event_id})
+        connection.commit()
+
+@metrics.instrument("database")
+def touch_webhook_events(event_ids):
+    """処理待ち・処理中のWebhookイベントの引き受け時刻を現在時刻に更新する関数"""
+    if not get_engine() or not event_ids: return
+    with get_engine().connect() as connection:
+        connection.execute(text("""
+            UPDATE webhook_events SET claimed_at = :now WHERE event_id IN :event_ids
+        """).bindparams(bindparam("event_ids", expanding=True)), {"now": time.time(), "event_ids": list(event_ids)})
+        connection.commit()
+
+@metrics.instrument("database")
+def claim_stale_webhook_events(claimed_before):
+    """指定時刻より前に引き受けられたまま残っているWebhookイベントを引き取る関数"""
+    if not get_engine(): return []
+    with get_engine().connect() as connection:
+        result = connection.execute(text("""
+            UPDATE webhook_events SET claimed_at = :now
+            WHERE claimed_at < :claimed_before
+            RETURNING event_id, payload, enqueued_at
+        """), {"now": time.time(), "claimed_before": claimed_before}).fetchall()
+        connection.commit()
+        return result
+
+@metrics.instrument("database")
+def get_forecast_cache(cell_keys, forecast_date):
+    """指定したグリッドセル・日付の予報キャッシュ (セルのキー, JSON, 取得時刻) の一覧を取得する関数"""
+    if not get_engine() or not cell_keys: return []
+    with get_engine().connect() as connection:
+        result = connection.execute(text("""
+            SELECT cell_key, payload, fetched_at FROM forecast_cache
+            WHERE forecast_date = :forecast_date AND cell_key IN :cell_keys
+        """).bindparams(bindparam("cell_keys", expanding=True)), {"forecast_date": forecast_date, "cell_keys": list(cell_keys)}).fetchall()
+        return result
+
+@metrics.instrument("database")
+def set_forecast_cache(entries):
+    """予報キャッシュ (セルのキー, 日付, JSON, 取得時刻) を保存する関数"""
+    if not get_engine() or not entries: return
+    with get_engine().connect() as connection:
+        connection.execute(text("""
+            INSERT INTO forecast_cache (cell_key, forecast_date, payload, fetched_at) VALUES (:cell_key, :forecast_date, :payload, :fetched_at)
+            ON CONFLICT(cell_key, forecast_date) DO UPDATE SET payload = :payload, fetched_at = :fetched_at
+        """), [{"cell_key": key, "forecast_date": day, "payload": payload, "fetched_at": fetched_at} for key, day, payload, fetched_at in entries])
+        connection.commit()
+
+@metrics.instrument("database")
+def delete_forecast_cache_before(forecast_date):
+    """指定した日付より前の予報キャッシュを削除する関数"""
+    if not get_engine(): return
+    with get_engine().connect() as connection:
+        connection.execute(text("DELETE FROM forecast_cache WHERE forecast_date < :forecast_date"), {"forecast_date": forecast_date})
+        connection.commit()
+
+if __name__ == "__main__":
+    # デプロイ時に実行するテーブルの作成: python database.py migrate
+    if sys.argv[1:] != ["migrate"]:
+        print("使い方: python database.py migrate")
+        sys.exit(1)
+    if not DATABASE_URL:
+        print("エラー: DATABASE_URLが設定されていません。")
+        sys.exit(1)
+    init_db()
+    print("テーブルの作成が完了しました。")
@@ -0,0 +1,192 @@
+import os
+import time
+import uuid
+import random
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from dotenv import load_dotenv
+import database
+import http_client
+import metrics
+from flex_templates import encode_body, encode_messages
+
+load_dotenv()
+CHANNEL_ACCESS_TOKEN = os.environ.get("LINE_CHANNEL_ACCESS_TOKEN")
+
+PUSH_URL = f"{http_client.LINE_API_BASE_URL}/v2/bot/message/push"
+MULTICAST_URL = f"{http_client.LINE_API_BASE_URL}/v2/bot/message/multicast"
+# LINEのマルチキャストAPIで1回に指定できる宛先の上限
+MULTICAST_CHUNK_SIZE = 500
+
+# 同時に送信するリクエスト数と、1秒あたりのリクエスト数の上限
+DISPATCH_CONCURRENCY = int(os.environ.get("DISPATCH_CONCURRENCY", "8"))
+DISPATCH_RATE_PER_SEC = float(os.environ.get("DISPATCH_RATE_PER_SEC", "100"))
+# 429/5xx応答時の再試行回数と、待ち時間（秒）の基準値・上限
+DISPATCH_MAX_RETRIES = int(os.environ.get("DISPATCH_MAX_RETRIES", "5"))
+DISPATCH_BACKOFF_BASE = float(os.environ.get("DISPATCH_BACKOFF_BASE", "1.0"))
+DISPATCH_BACKOFF_MAX = float(os.environ.get("DISPATCH_BACKOFF_MAX", "60.0"))
+# 送信を引き受けたまま完了が記録されない場合に、停止したとみなして他のワーカーが送り直すまでの秒数（再試行を含む送信時間より長くする）
+DISPATCH_CLAIM_LEASE = int(os.environ.get("DISPATCH_CLAIM_LEASE", "900"))
+
+class TokenBucket:
+    """トークンバケット方式でリクエストの送信ペースを制限するクラス"""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """トークンを1つ取得できるまで待機する"""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+                self.updated_at = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+class DispatchStats:
+    """1回の配信処理の送信数・再試行数・失敗ユーザーを集計するクラス"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started_at = time.monotonic()
+        self.requests = 0
+        self.retries = 0
+        self.delivered = 0
+        self.skipped = 0
+        self.failed_user_ids = []
+
+    def add(self, **counts):
+        with self.lock:
+            for name, value in counts.items():
+                setattr(self, name, getattr(self, name) + value)
+
+    def report(self, label):
+        elapsed = time.monotonic() - self.started_at
+        throughput = self.delivered / elapsed if elapsed > 0 else 0.0
+        print(f"[{label}] 送信完了: {self.delivered}人, スキップ(送信済み): {self.skipped}人, 失敗: {len(self.failed_user_ids)}人")
+        print(f"[{label}] リクエスト数: {self.requests}, 再試行数: {self.retries}, 所要時間: {elapsed:.1f}秒, スループット: {throughput:.1f}人/秒")
+        if self.failed_user_ids:
+            print(f"[{label}] 送信に失敗したユーザー: {', '.join(self.failed_user_ids)}")
+
+# 同じプロセス内の全ての送信で共有するレート制限
+_bucket = TokenBucket(DISPATCH_RATE_PER_SEC)
+
+def _retry_delay(response, attempt):
+    """Retry-Afterヘッダーがあればそれに従い、なければ指数バックオフで待ち時間を決める"""
+    if response is not None:
+        retry_after = response.headers.get("Retry-After")
+        if retry_after:
+            try:
+                return min(float(retry_after), DISPATCH_BACKOFF_MAX)
+            except ValueError:
+                pass
+    delay = min(DISPATCH_BACKOFF_BASE * (2 ** attempt), DISPATCH_BACKOFF_MAX)
+    return delay * random.uniform(0.5, 1.0)
+
+def post_with_retry(url, encoded_body, stats, bucket, retry_key=None):
+    """エンコード済みの本文をLINE APIへPOSTし、429/5xxや通信エラーの場合はバックオフしながら再試行する関数（成功時True）
+    retry_keyを渡すと、そのリトライキーで送る（停止したワーカーの送信を送り直す場合など）。"""
+    # 再試行しても二重送信にならないよう、同じリトライキーを使い回す
+    headers = {
+        "Content-Type": "application/json; charset=UTF-8",
+        "Authorization": f"Bearer {CHANNEL_ACCESS_TOKEN}",
+        "X-Line-Retry-Key": retry_key or str(uuid.uuid4()),
+    }
+    for attempt in range(DISPATCH_MAX_RETRIES + 1):
+        bucket.acquire()
+        stats.add(requests=1)
+        response = None
+        try:
+            response = http_client.post(url, headers=headers, data=encoded_body)
+            # 409はリトライキーが受理済み（前回の送信が成功済み）であることを示す
+            if response.status_code < 400 or response.status_code == 409:
+                return True
+            if response.status_code != 429 and response.status_code < 500:
+                print(f"LINE APIエラー: HTTP {response.status_code} 応答内容: {response.text}")
+                return False
+        except requests.exceptions.RequestException as e:
+            print(f"LINE API通信エラー: {e}")
+        if attempt < DISPATCH_MAX_RETRIES:
+            stats.add(retries=1)
+            time.sleep(_retry_delay(response, attempt))
+    print(f"LINE APIへの送信を{DISPATCH_MAX_RETRIES}回再試行しましたが失敗しました。")
+    return False
+
+def build_jobs(deliveries, mode):
+    """(ユーザーID, メッセージリスト) の一覧を、送信リクエスト単位 (URL, エンコード済みのメッセージ, 宛先ユーザーID) に変換する関数"""
+    if mode != "multicast":
+        return [(PUSH_URL, encode_messages(messages), [user_id]) for user_id, messages in deliveries]
+
+    # 同じ内容のメッセージを受け取るユーザーをまとめ、エンコード済みのメッセージを使い回す
+    groups = {}
+    for user_id, messages in deliveries:
+        groups.setdefault(encode_messages(messages), []).append(user_id)
+
+    jobs = []
+    for encoded_messages, user_ids in groups.items():
+        for i in range(0, len(user_ids), MULTICAST_CHUNK_SIZE):
+            jobs.append((MULTICAST_URL, encoded_messages, user_ids[i:i + MULTICAST_CHUNK_SIZE]))
+    return jobs
+
+def dispatch(run_id, deliveries, mode="multicast", stats=None, on_delivered=None):
+    """メッセージを並列・レート制限付きで送信し、送信済みユーザーをチェックポイントとして記録する関数
+    送信の直前にユーザーごとの送信をDB上で引き受けるため、同じrun_idで再実行した場合や
+    複数のワーカーが同時に実行した場合でも、同じユーザーに二重に送信することはない。
+    バッチごとに呼び出す場合は、同じstatsを渡すと実行全体で集計される。戻り値はDispatchStats。
+    on_deliveredを渡すと、送信に成功したユーザーIDのリストを引数に、送信ごとに呼び出す。
+    停止したワーカーが引き受けたまま（DISPATCH_CLAIM_LEASE秒以上）送信中になっているユーザーには、
+    保存されたリクエストを同じリトライキーで送り直す（送信済みであればLINEが409を返すため、二重には届かない）。
+    送り直すリクエストには、deliveriesに含まれないユーザー（前回の実行で同じリクエストにまとめたユーザー）も含まれ、
+    その場合はon_deliveredにもそれらのユーザーIDが渡される。"""
+    stats = stats or DispatchStats()
+    claim_token = str(uuid.uuid4())
+
+    def send(url, body, targets, retry_key):
+        with metrics.timed("line_send", "multicast" if url == MULTICAST_URL else "push") as timer:
+            sent = post_with_retry(url, body, stats, _bucket, retry_key=retry_key)
+            timer.outcome = "success" if sent else "failure"
+        if sent:
+            database.mark_users_delivered(run_id, targets, claim_token, retry_key=retry_key)
+            stats.add(delivered=len(targets))
+            if on_delivered:
+                on_delivered(targets)
+        else:
+            database.release_deliveries(run_id, targets, claim_token, retry_key=retry_key)
+            stats.add(failed_user_ids=targets)
+
+    user_ids = [user_id for user_id, _ in deliveries]
+    for retry_key, url, body, targets in database.take_over_stale_deliveries(run_id, user_ids, claim_token, time.time() - DISPATCH_CLAIM_LEASE):
+        print(f"送信途中で停止した送信（{len(targets)}人）を、同じリトライキーで送り直します。")
+        send(url, body.encode("utf-8"), targets, retry_key)
+
+    delivered_user_ids = database.get_delivered_user_ids(run_id, user_ids)
+    pending = [(user_id, messages) for user_id, messages in deliveries if user_id not in delivered_user_ids]
+    stats.add(skipped=len(deliveries) - len(pending))
+
+    def run_job(job):
+        url, encoded_messages, user_ids = job
+        retry_key = str(uuid.uuid4())
+        claimed = database.claim_deliveries(run_id, user_ids, claim_token, retry_key)
+        targets = [user_id for user_id in user_ids if user_id in claimed]
+        stats.add(skipped=len(user_ids) - len(targets))
+        if not targets:
+            return
+        to = targets if url == MULTICAST_URL else targets[0]
+        body = encode_body({"to": to}, encoded_messages)
+        database.save_delivery_request(retry_key, run_id, url, body.decode("utf-8"), claim_token)
+        send(url, body, targets, retry_key)
+
+    with ThreadPoolExecutor(max_workers=DISPATCH_CONCURRENCY) as executor:
+        # list()で全ジョブの完了を待ち、ジョブ内の例外もここで送出させる
+        list(executor.map(run_job, build_jobs(pending, mode)))
+
+    return stats
@@ -0,0 +1,71 @@
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import user_state
+
+# 1回の配信に含まれるイベントのうち、別々のユーザーのものを同時に処理する数
+EVENT_CONCURRENCY = int(os.environ.get("WEBHOOK_EVENT_CONCURRENCY", "8"))
+
+class EventBatch:
+    """1回のWebhook配信に含まれるイベントで共有する、ユーザー状態の読み込み結果と書き込み予定
+
+    配信に含まれる全ユーザーの状態は最初にまとめて（キャッシュになければ1回のクエリで）読み込み、
+    状態や登録地の変更は flush() でまとめて書き込む。"""
+
+    def __init__(self, user_ids):
+        self.lock = threading.Lock()
+        self.states = user_state.get_states(user_ids)
+        self.pending_states = {}
+        self.pending_locations = {}
+
+    def get_state(self, user_id):
+        with self.lock:
+            return self.states.get(user_id)
+
+    def set_state(self, user_id, state):
+        with self.lock:
+            self.states[user_id] = state
+            self.pending_states[user_id] = state
+
+    def set_location(self, user_id, city_name, lat, lon):
+        """登録地を設定し、状態を'normal'に戻す"""
+        with self.lock:
+            self.pending_locations[user_id] = (city_name, lat, lon)
+            self.states[user_id] = 'normal'
+            self.pending_states.pop(user_id, None)
+
+    def flush(self):
+        """変更された状態と登録地をまとめて書き込む"""
+        with self.lock:
+            states, locations = self.pending_states, self.pending_locations
+            self.pending_states, self.pending_locations = {}, {}
+        user_state.set_states_and_locations(states, locations)
+
+_executor = ThreadPoolExecutor(max_workers=EVENT_CONCURRENCY)
+
+def event_user_id(event):
+    return getattr(event.source, "user_id", None)
+
+def process_events(events, handle_event):
+    """1回の配信に含まれるイベントを処理する関数
+    別々のユーザーのイベントは並行して処理し、同じユーザーのイベントは届いた順に処理する。
+    handle_eventは (イベント, EventBatch) を受け取る。"""
+    events_by_user = {}
+    for event in events:
+        events_by_user.setdefault(event_user_id(event), []).append(event)
+    batch = EventBatch([user_id for user_id in events_by_user if user_id is not None])
+
+    def run_user_events(user_events):
+        for event in user_events:
+            try:
+                handle_event(event, batch)
+            except Exception as e:
+                print(f"Webhookイベントの処理中にエラーが発生しました: {e}")
+
+    try:
+        if len(events_by_user) == 1:
+            run_user_events(events)
+        else:
+            list(_executor.map(run_user_events, events_by_user.values()))
+    finally:
+        batch.flush()
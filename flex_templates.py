@@ -0,0 +1,61 @@
+import re
+import json
+
+# テンプレート中で差し込み位置を表すプレースホルダー（JSONの文字列値全体を置き換える）
+SLOT_PATTERN = re.compile(r'"@@(\w+)@@"')
+
+def slot(name):
+    """テンプレートの差し込み位置を表す文字列を返す関数"""
+    return f"@@{name}@@"
+
+def encode_value(value):
+    """値をLINE APIに送るJSON（UTF-8）にエンコードする関数"""
+    return json.dumps(value, ensure_ascii=False, separators=(",", ":")).encode('utf-8')
+
+class Template:
+    """メッセージの骨組みを一度だけJSONにエンコードしておき、差し込み位置だけを埋めてバイト列を作るクラス"""
+
+    def __init__(self, skeleton):
+        parts = SLOT_PATTERN.split(encode_value(skeleton).decode('utf-8'))
+        # 偶数番目が固定部分、奇数番目が差し込み位置の名前
+        self.static_parts = [part.encode('utf-8') for part in parts[0::2]]
+        self.slot_names = parts[1::2]
+
+    def render(self, **values):
+        """差し込み位置を埋めたメッセージを、エンコード済みのバイト列で返す"""
+        chunks = [self.static_parts[0]]
+        for name, static_part in zip(self.slot_names, self.static_parts[1:]):
+            chunks.append(encode_value(values[name]))
+            chunks.append(static_part)
+        return b"".join(chunks)
+
+def encode_messages(messages):
+    """メッセージのリスト（辞書またはエンコード済みのバイト列）をJSON配列のバイト列にする関数"""
+    return b"[" + b",".join(m if isinstance(m, bytes) else encode_value(m) for m in messages) + b"]"
+
+def encode_body(fields, messages):
+    """宛先などのフィールドとメッセージのリストから、LINE APIのリクエスト本文を組み立てる関数
+    messagesにエンコード済みのバイト列（encode_messagesの戻り値）を渡すと、そのまま使い回す。"""
+    encoded_messages = messages if isinstance(messages, bytes) else encode_messages(messages)
+    return encode_value(fields)[:-1] + b',"messages":' + encoded_messages + b"}"
+
+def _detail_row(label, value_slot):
+    return {"type": "box", "layout": "baseline", "spacing": "sm", "contents": [{"type": "text", "text": label, "color": "#AAAAAA", "size": "sm", "flex": 2}, {"type": "text", "text": slot(value_slot), "wrap": True, "color": "#666666", "size": "sm", "flex": 5}]}
+
+# 天気予報のFlex Message（インポート時に一度だけ組み立てる）
+FORECAST_TEMPLATE = Template({
+    "type": "flex", "altText": slot("alt_text"),
+    "contents": { "type": "bubble", "direction": 'ltr',
+        "header": {"type": "box", "layout": "vertical", "contents": [{"type": "text", "text": "今日の天気予報", "weight": "bold", "size": "xl", "color": "#FFFFFF", "align": "center"}], "backgroundColor": "#5C6BC0", "paddingTop": "12px", "paddingBottom": "12px"},
+        "body": {"type": "box", "layout": "vertical", "spacing": "md", "contents": [
+            {"type": "box", "layout": "vertical", "contents": [{"type": "text", "text": slot("city_name"), "size": "lg", "weight": "bold", "color": "#5C6BC0", "wrap": True}, {"type": "text", "text": slot("date"), "size": "sm", "color": "#AAAAAA"}]},
+            {"type": "separator", "margin": "md"},
+            {"type": "box", "layout": "vertical", "margin": "lg", "spacing": "sm", "contents": [
+                _detail_row("天気", "weather"),
+                _detail_row("最高気温", "temp_max"),
+                _detail_row("最低気温", "temp_min"),
+                _detail_row("降水確率", "pop"),
+            ]}
+        ]}
+    }
+})
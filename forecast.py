@@ -0,0 +1,222 @@
+import os
+import sys
+import json
+import time
+import threading
+import functools
+from datetime import datetime, date
+from zoneinfo import ZoneInfo
+import http_client
+from dotenv import load_dotenv
+import database
+import metrics
+import flex_templates
+
+load_dotenv()
+JST = ZoneInfo("Asia/Tokyo")
+
+# 同じ予報を共有するとみなす緯度・経度の丸め桁数（小数2桁 ≒ 1km四方）
+GRID_DECIMALS = int(os.environ.get("FORECAST_GRID_DECIMALS", "2"))
+# Open-Meteoへ1回のリクエストでまとめて問い合わせる地点数の上限
+OPEN_METEO_BATCH_SIZE = int(os.environ.get("OPEN_METEO_BATCH_SIZE", "100"))
+# Open-Meteoの予報はおおむね1時間ごとに更新されるため、その間は取得済みの予報をそのまま使う。
+# 有効期間を過ぎても FORECAST_STALE_TTL 秒までは古い予報を返しつつ、裏で取り直す
+FORECAST_CACHE_TTL = int(os.environ.get("FORECAST_CACHE_TTL", "3600"))
+FORECAST_STALE_TTL = int(os.environ.get("FORECAST_STALE_TTL", str(6 * 3600)))
+
+# 深夜0時前の事前取得で翌日分もキャッシュできるよう、2日分の予報を取得する
+OPEN_METEO_DAILY_PARAMS = "daily=weather_code,temperature_2m_max,temperature_2m_min,precipitation_probability_max&timezone=Asia%2FTokyo&forecast_days=2"
+DAILY_FIELDS = ("weather_code", "temperature_2m_max", "temperature_2m_min", "precipitation_probability_max")
+WEATHER_CODES = {0:"快晴",1:"晴れ",2:"一部曇",3:"曇り",45:"霧",48:"霧氷",51:"霧雨",53:"霧雨",55:"霧雨",56:"着氷性の霧雨",57:"着氷性の霧雨",61:"小雨",63:"雨",65:"大雨",66:"着氷性の雨",67:"着氷性の雨",71:"小雪",73:"雪",75:"大雪",77:"霧雪",80:"にわか雨",81:"にわか雨",82:"激しいにわか雨",85:"弱いしゅう雪",86:"強いしゅう雪",95:"雷雨",96:"雷雨と雹",99:"雷雨と雹"}
+FETCH_FAILED_MESSAGE = {"type": "text", "text": "天気情報の取得に失敗しました。"}
+
+# プロセス内キャッシュ: {(セル, 日付文字列): (日次予報データ, 取得時刻)}
+_memory_cache = {}
+_cache_lock = threading.Lock()
+# 裏で取り直し中のキー（同じキーを重複して取り直さないため）
+_revalidating = set()
+
+def today_jst():
+    """日本時間の今日の日付を返す関数"""
+    return datetime.now(JST).date()
+
+def get_grid_cell(lat, lon):
+    """緯度・経度をグリッドセル（丸めた座標のタプル）に変換する関数"""
+    return (round(lat, GRID_DECIMALS), round(lon, GRID_DECIMALS))
+
+def cell_key(cell):
+    """グリッドセルをDBキャッシュのキー文字列に変換する関数"""
+    return f"{cell[0]},{cell[1]}"
+
+@metrics.instrument("flex", "build_forecast")
+def build_forecast_message(daily, city_name):
+    """Open-Meteoの日次予報データから、エンコード済みの天気予報Flex Messageを作る関数"""
+    return _render_forecast_message(
+        city_name, daily["time"][0], daily["weather_code"][0],
+        daily["temperature_2m_max"][0], daily["temperature_2m_min"][0], daily["precipitation_probability_max"][0],
+    )
+
+@functools.lru_cache(maxsize=4096)
+def _render_forecast_message(city_name, day, weather_code, temp_max, temp_min, pop):
+    # 同じ地名・同じ予報の受信者には、同じバイト列を使い回す
+    return flex_templates.FORECAST_TEMPLATE.render(
+        alt_text=f"{city_name}の天気予報",
+        city_name=city_name,
+        date=datetime.strptime(day, '%Y-%m-%d').strftime('%Y年%m月%d日'),
+        weather=WEATHER_CODES.get(weather_code, "不明"),
+        temp_max=f"{temp_max}°C",
+        temp_min=f"{temp_min}°C",
+        pop=f"{pop}%",
+    )
+
+# --- Open-Meteoからの取得 ---
+@metrics.instrument("forecast", "fetch")
+def fetch_open_meteo_daily_batch(cells):
+    """複数地点の日次予報を、Open-Meteoの複数座標指定で1回のリクエストにまとめて取得する関数"""
+    latitudes = ",".join(str(lat) for lat, _ in cells)
+    longitudes = ",".join(str(lon) for _, lon in cells)
+    api_url = f"{http_client.OPEN_METEO_BASE_URL}/v1/forecast?latitude={latitudes}&longitude={longitudes}&{OPEN_METEO_DAILY_PARAMS}"
+    response = http_client.get(api_url)
+    response.raise_for_status()
+    data = response.json()
+    # 1地点だけの場合はオブジェクト、複数地点の場合は配列で返ってくる
+    if isinstance(data, dict):
+        data = [data]
+    return [item["daily"] for item in data]
+
+def split_daily_by_date(daily):
+    """複数日分の日次予報データを、{日付文字列: 1日分の日次予報データ} に分割する関数"""
+    return {
+        day: {"time": [day], **{field: [daily[field][i]] for field in DAILY_FIELDS}}
+        for i, day in enumerate(daily["time"])
+    }
+
+def fetch_and_store(cells):
+    """グリッドセルの予報をOPEN_METEO_BATCH_SIZE件ずつまとめて取得し、キャッシュに保存する関数
+    戻り値は ({(セル, 日付文字列): 1日分の日次予報データ}, リクエスト回数) のタプル。"""
+    cells = list(cells)
+    fetched = {}
+    request_count = 0
+    for i in range(0, len(cells), OPEN_METEO_BATCH_SIZE):
+        chunk = cells[i:i + OPEN_METEO_BATCH_SIZE]
+        request_count += 1
+        try:
+            dailies = fetch_open_meteo_daily_batch(chunk)
+        except Exception as e:
+            print(f"Open-Meteo API Error ({len(chunk)}地点): {e}")
+            continue
+        fetched_at = time.time()
+        entries = []
+        for cell, daily in zip(chunk, dailies):
+            for day, day_daily in split_daily_by_date(daily).items():
+                fetched[(cell, day)] = day_daily
+                entries.append((cell_key(cell), day, json.dumps(day_daily), fetched_at))
+                with _cache_lock:
+                    _memory_cache[(cell, day)] = (day_daily, fetched_at)
+        try:
+            database.set_forecast_cache(entries)
+        except Exception as e:
+            print(f"Forecast Cache Error: {e}")
+    _prune_memory_cache()
+    return fetched, request_count
+
+def _prune_memory_cache():
+    """昨日以前の予報をプロセス内キャッシュから取り除く"""
+    today = today_jst().isoformat()
+    with _cache_lock:
+        for key in [key for key in _memory_cache if key[1] < today]:
+            del _memory_cache[key]
+
+# --- キャッシュの参照 ---
+def _revalidate(cells):
+    try:
+        fetch_and_store(cells)
+    finally:
+        with _cache_lock:
+            _revalidating.difference_update(cells)
+
+def _lookup(cells, day):
+    """キャッシュから予報を探し、({セル: (日次予報データ, 取得時刻)}, 見つからなかったセルのリスト) を返す"""
+    found = {}
+    with _cache_lock:
+        for cell in cells:
+            item = _memory_cache.get((cell, day))
+            if item is not None:
+                found[cell] = item
+
+    missing = [cell for cell in cells if cell not in found]
+    if missing:
+        try:
+            keys = {cell_key(cell): cell for cell in missing}
+            for key, payload, fetched_at in database.get_forecast_cache(list(keys), day):
+                item = (json.loads(payload), fetched_at)
+                found[keys[key]] = item
+                with _cache_lock:
+                    _memory_cache[(keys[key], day)] = item
+        except Exception as e:
+            print(f"Forecast Cache Error: {e}")
+    return found, [cell for cell in cells if cell not in found]
+
+def get_daily_forecasts(cells, forecast_date=None):
+    """グリッドセルごとの1日分の日次予報を、キャッシュを優先して取得する関数
+    有効期間内の予報はそのまま、期限切れでもFORECAST_STALE_TTL以内なら古い予報を返して裏で取り直す。
+    戻り値は ({セル: 日次予報データ}, Open-Meteoへのリクエスト回数) のタプル。取得に失敗したセルは含まれない。"""
+    day = (forecast_date or today_jst()).isoformat()
+    cells = list(dict.fromkeys(cells))
+    now = time.time()
+    found, missing = _lookup(cells, day)
+
+    forecasts = {}
+    stale = []
+    for cell, (daily, fetched_at) in found.items():
+        age = now - fetched_at
+        if age <= FORECAST_CACHE_TTL:
+            forecasts[cell] = daily
+        elif age <= FORECAST_CACHE_TTL + FORECAST_STALE_TTL:
+            forecasts[cell] = daily
+            stale.append(cell)
+        else:
+            missing.append(cell)
+
+    if stale:
+        with _cache_lock:
+            stale = [cell for cell in stale if cell not in _revalidating]
+            _revalidating.update(stale)
+        if stale:
+            threading.Thread(target=_revalidate, args=(stale,), daemon=True).start()
+
+    request_count = 0
+    if missing:
+        fetched, request_count = fetch_and_store(missing)
+        for cell in missing:
+            if (cell, day) in fetched:
+                forecasts[cell] = fetched[(cell, day)]
+    return forecasts, request_count
+
+def get_forecast_message(lat, lon, city_name):
+    """指定した地点の今日の天気予報のFlex Message（エンコード済み）を取得する関数"""
+    cell = get_grid_cell(lat, lon)
+    forecasts, _ = get_daily_forecasts([cell])
+    if cell not in forecasts:
+        return FETCH_FAILED_MESSAGE
+    return build_forecast_message(forecasts[cell], city_name)
+
+def prewarm(forecast_date=None):
+    """登録済みの全地点の予報を事前に取得してキャッシュに入れる関数（定期通知の直前に実行する）
+    forecast_dateを省略した場合、0時前の実行なら翌日分、それ以降なら当日分を対象とする。"""
+    now = datetime.now(JST)
+    if forecast_date is None:
+        forecast_date = now.date() if now.hour < 12 else date.fromordinal(now.date().toordinal() + 1)
+    database.auto_migrate()
+    database.delete_forecast_cache_before(today_jst().isoformat())
+    cells = {get_grid_cell(lat, lon) for users in database.iter_users_with_location() for _, _, lat, lon in users}
+    fetched, request_count = fetch_and_store(cells)
+    warmed = sum(1 for cell in cells if (cell, forecast_date.isoformat()) in fetched)
+    print(f"{forecast_date.isoformat()}の予報を{warmed}/{len(cells)}セル分、{request_count}回のリクエストで事前取得しました。")
+    metrics.print_summary("prewarm")
+
+if __name__ == "__main__":
+    if len(sys.argv) >= 2 and sys.argv[1] == "prewarm":
+        prewarm(date.fromisoformat(sys.argv[2]) if len(sys.argv) >= 3 else None)
+    else:
+        print("使い方: python forecast.py prewarm [YYYY-MM-DD]")
@@ -0,0 +1,168 @@
+import os
+import bisect
+import threading
+import unicodedata
+from array import array
+from collections import namedtuple
+
+# 同梱の市区町村データ（TSV: 都道府県, 政令市, 市区町村, 読み, 緯度, 経度）
+GAZETTEER_PATH = os.environ.get("GAZETTEER_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "municipalities.tsv"))
+# 候補として返す地名の最大数（LINEのクイックリプライは13個まで）
+MAX_SUGGESTIONS = 10
+# 入力ミスとみなして候補を探す、入力の最小の長さ（短い地名どうしは1文字違いでも別の地名のことが多い）
+TYPO_MIN_LENGTH = 3
+
+# 取り除いて「大阪」「しんじゅく」のような入力にも一致させる接尾辞と、その読み
+SUFFIX_READINGS = {"市": ("し",), "区": ("く",), "町": ("まち", "ちょう"), "村": ("むら", "そん")}
+
+# 地名の入力で取り違えやすい字の組（異体字・変換ミス）
+CONFUSABLE_CHARS = {frozenset(pair) for pair in ("阪坂", "崎埼", "沢澤", "浜濱", "島嶋", "辺邊", "竜龍", "国國", "関關", "条條", "富冨", "桧檜", "栃杤", "ヶけ", "ヶが", "ヶヵ")}
+
+Place = namedtuple("Place", ["label", "prefecture", "city", "name", "kana", "lat", "lon"])
+# kind は exact（一意に決まった）/ ambiguous（同名の地名が複数）/ typo（入力ミスの候補）/ prefix（前方一致の候補）/ none
+Match = namedtuple("Match", ["kind", "places"])
+
+class Gazetteer:
+    """市区町村名・読みから座標を引く地名辞書
+
+    地名は配列（名前のリストと、緯度・経度のarray）で保持し、
+    検索キー（漢字・読み・接尾辞なし・都道府県付き・政令市付き）からの完全一致は辞書で、
+    前方一致はソート済みのキーの二分探索で、入力ミス（1文字違い）は1文字削除したキーの逆引きで探す。"""
+
+    def __init__(self, rows):
+        self.prefectures, self.cities, self.names, self.kanas = [], [], [], []
+        self.lats, self.lons = array("d"), array("d")
+        index = {}
+        for prefecture, city, name, kana, lat, lon in rows:
+            i = len(self.names)
+            self.prefectures.append(prefecture)
+            self.cities.append(city)
+            self.names.append(name)
+            self.kanas.append(kana)
+            self.lats.append(float(lat))
+            self.lons.append(float(lon))
+            for key in self._keys(prefecture, city, name, kana):
+                positions = index.setdefault(key, [])
+                if i not in positions:
+                    positions.append(i)
+        self.index = {key: tuple(positions) for key, positions in index.items()}
+        self.sorted_keys = sorted(self.index)
+        # 1文字削除したキーからの逆引き（入力側も1文字削除して引けば、1文字違いのキーが見つかる）
+        self.deletions = {}
+        for key in self.sorted_keys:
+            for variant in deletion_variants(key):
+                self.deletions.setdefault(variant, []).append(key)
+        name_counts = {}
+        for name in self.names:
+            name_counts[name] = name_counts.get(name, 0) + 1
+        self.name_counts = name_counts
+
+    @staticmethod
+    def _keys(prefecture, city, name, kana):
+        name, kana = normalize(name), normalize(kana)
+        keys = [name, kana, normalize(prefecture + city + name), normalize(prefecture + name)]
+        if city:
+            keys.append(normalize(city + name))
+        for suffix, readings in SUFFIX_READINGS.items():
+            if name.endswith(suffix) and len(name) - len(suffix) >= (1 if suffix == "市" else 2):
+                keys.append(name[:-len(suffix)])
+                keys += [kana[:-len(reading)] for reading in readings if kana.endswith(reading)]
+                break
+        return keys
+
+    def place(self, i):
+        """i番目の地名を返す（ラベルは、同名の地名があれば政令市名や都道府県名を付けたもの。そのまま検索すれば一意に決まる）"""
+        name, city, prefecture = self.names[i], self.cities[i], self.prefectures[i]
+        if self.name_counts[name] == 1:
+            label = name
+        elif city:
+            label = city + name
+        else:
+            label = prefecture + name
+        return Place(label, prefecture, city, name, self.kanas[i], self.lats[i], self.lons[i])
+
+    def _places(self, positions):
+        unique = list(dict.fromkeys(positions))
+        return [self.place(i) for i in unique[:MAX_SUGGESTIONS]]
+
+    def lookup(self, text):
+        """地名を検索して Match を返す関数"""
+        key = normalize(text)
+        if not key:
+            return Match("none", [])
+
+        positions = self.index.get(key)
+        if positions:
+            return Match("exact" if len(positions) == 1 else "ambiguous", self._places(positions))
+
+        if len(key) >= 2:
+            prefix_positions = []
+            start = bisect.bisect_left(self.sorted_keys, key)
+            for candidate in self.sorted_keys[start:]:
+                if not candidate.startswith(key):
+                    break
+                prefix_positions += self.index[candidate]
+            if prefix_positions:
+                return Match("prefix", self._places(prefix_positions))
+
+        if len(key) >= TYPO_MIN_LENGTH:
+            candidates = set()
+            for variant in deletion_variants(key):
+                candidates.update(candidate for candidate in self.deletions.get(variant, ()) if is_one_edit_apart(key, candidate))
+            if candidates:
+                # 「大坂」と「大阪」のような、取り違えやすい字の違いだけのものを先に並べる
+                ranked = sorted(candidates, key=lambda candidate: (not is_confusable(key, candidate), candidate))
+                return Match("typo", self._places([i for candidate in ranked for i in self.index[candidate]]))
+
+        return Match("none", [])
+
+def normalize(text):
+    """検索キー用に正規化する関数（NFKC正規化・空白除去・カタカナをひらがなに変換）"""
+    text = "".join(unicodedata.normalize("NFKC", text).split())
+    return "".join(chr(ord(c) - 0x60) if "ァ" <= c <= "ヴ" else c for c in text)
+
+def deletion_variants(text):
+    """文字列そのものと、1文字削除した文字列をすべて返す関数"""
+    return {text} | {text[:i] + text[i + 1:] for i in range(len(text))}
+
+def is_confusable(a, b):
+    """同じ長さの2つの文字列の違いが、取り違えやすい字（CONFUSABLE_CHARS）の1組だけかどうか"""
+    if len(a) != len(b):
+        return False
+    diffs = [(x, y) for x, y in zip(a, b) if x != y]
+    return len(diffs) == 1 and frozenset(diffs[0]) in CONFUSABLE_CHARS
+
+def is_one_edit_apart(a, b):
+    """2つの文字列が、1文字の置換・挿入・削除で一致するかどうか"""
+    if len(a) > len(b):
+        a, b = b, a
+    if len(b) - len(a) > 1:
+        return False
+    i = 0
+    while i < len(a) and a[i] == b[i]:
+        i += 1
+    if len(a) == len(b):
+        return a[i + 1:] == b[i + 1:] and i < len(a)
+    return a[i:] == b[i + 1:]
+
+def load(path=GAZETTEER_PATH):
+    """TSVファイルから地名辞書を読み込む関数（#で始まる行は読み飛ばす）"""
+    with open(path, encoding="utf-8") as f:
+        rows = [line.rstrip("\n").split("\t") for line in f if line.strip() and not line.startswith("#")]
+    return Gazetteer(rows)
+
+_gazetteer = None
+_load_lock = threading.Lock()
+
+def get_gazetteer():
+    """同梱の地名辞書を返す関数（最初に呼ばれたときに読み込む）"""
+    global _gazetteer
+    if _gazetteer is None:
+        with _load_lock:
+            if _gazetteer is None:
+                _gazetteer = load()
+    return _gazetteer
+
+def lookup(text):
+    """同梱の地名辞書で地名を検索する関数"""
+    return get_gazetteer().lookup(text)
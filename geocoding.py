@@ -0,0 +1,143 @@
+import os
+import time
+import threading
+import unicodedata
+import http_client
+from dotenv import load_dotenv
+import database
+import gazetteer
+import metrics
+from ttl_cache import TTLCache
+
+load_dotenv()
+OPENWEATHER_API_KEY = os.environ.get("OPENWEATHER_API_KEY")
+
+# プロセス内キャッシュの最大件数と有効期間（秒）。見つからなかった地名は短めに保持する
+GEOCODE_CACHE_SIZE = int(os.environ.get("GEOCODE_CACHE_SIZE", "4096"))
+GEOCODE_CACHE_TTL = int(os.environ.get("GEOCODE_CACHE_TTL", str(30 * 24 * 3600)))
+GEOCODE_NEGATIVE_TTL = int(os.environ.get("GEOCODE_NEGATIVE_TTL", str(3600)))
+
+# 同じ地名の別の表記（「大阪市」と「大阪」など）として、キャッシュを引き合う接尾辞。
+# 町は同名の市・区と別の場所のことが多い（「府中町」と「府中市」など）ため含めない
+CITY_SUFFIXES = ("市", "区")
+
+_memory_cache = TTLCache(GEOCODE_CACHE_SIZE)
+_stats_lock = threading.Lock()
+_stats = {"gazetteer_hits": 0, "memory_hits": 0, "db_hits": 0, "misses": 0, "negative_hits": 0, "api_calls": 0, "api_seconds": 0.0}
+
+def _count(name, value=1):
+    with _stats_lock:
+        _stats[name] += value
+
+def get_cache_stats():
+    """ジオコーディングキャッシュのヒット数・ミス数・API呼び出し回数を取得する関数"""
+    with _stats_lock:
+        stats = dict(_stats)
+    lookups = stats["memory_hits"] + stats["db_hits"] + stats["misses"]
+    stats["hit_ratio"] = (stats["memory_hits"] + stats["db_hits"]) / lookups if lookups else 0.0
+    stats["memory_entries"] = len(_memory_cache.data)
+    return stats
+
+def normalize_city_name(city_name):
+    """地名をキャッシュのキー用に正規化する関数（NFKC正規化・空白除去）"""
+    return "".join(unicodedata.normalize("NFKC", city_name).split())
+
+def city_name_aliases(key):
+    """正規化した地名の、接尾辞だけが違う別の表記を返す関数
+    「大阪市」「大阪区」なら「大阪」、「大阪」なら「大阪市」「大阪区」。町で終わる地名には別の表記を使わない。"""
+    for suffix in CITY_SUFFIXES:
+        if key.endswith(suffix) and len(key) > len(suffix):
+            return [key[:-len(suffix)]]
+    if key.endswith("町"):
+        return []
+    return [key + suffix for suffix in CITY_SUFFIXES]
+
+def fetch_coords_from_api(city_name):
+    """OpenWeatherMapのジオコーディングAPIで地名から座標を取得する関数
+    見つからなければNone、通信エラーなどの場合は例外を送出する。"""
+    api_url = f"{http_client.OPENWEATHER_BASE_URL}/geo/1.0/direct?q={city_name},JP&limit=1&appid={OPENWEATHER_API_KEY}"
+    started_at = time.monotonic()
+    try:
+        response = http_client.get(api_url)
+        response.raise_for_status()
+        data = response.json()
+    finally:
+        _count("api_calls")
+        _count("api_seconds", time.monotonic() - started_at)
+    if data:
+        return {"lat": data[0]["lat"], "lon": data[0]["lon"]}
+    return None
+
+def _remember(key, coords):
+    ttl = GEOCODE_CACHE_TTL if coords else GEOCODE_NEGATIVE_TTL
+    _memory_cache.set(key, coords, ttl)
+    database.set_geocode_cache([key], coords, time.time() + ttl)
+
+def _cached_coords(key):
+    """キャッシュを引いて (キャッシュの有無, 座標またはNone, 結果の種類) を返す"""
+    coords, found = _memory_cache.get(key)
+    if found:
+        return True, coords, "memory_hit"
+    found, coords, expires_at = database.get_geocode_cache(key)
+    if found:
+        _memory_cache.set(key, coords, max(0, expires_at - time.time()))
+        return True, coords, "db_hit"
+    return False, None, None
+
+def resolve_city(city_name):
+    """地名を解決する関数。(座標またはNone, 表示用の地名, 候補の地名のリスト) を返す
+    同梱の地名辞書（全国の市区町村と政令市の区）で一意に決まればAPIは呼ばない。同名の地名が複数ある場合は候補を返す。
+    地名辞書にない地名はキャッシュとAPIで検索し、見つからなかった場合だけ地名辞書の候補（前方一致・入力ミス）を返す。"""
+    with metrics.timed("geocode", "gazetteer") as timer:
+        match = gazetteer.lookup(city_name)
+        timer.outcome = match.kind
+    if match.kind == "exact":
+        _count("gazetteer_hits")
+        place = match.places[0]
+        return {"lat": place.lat, "lon": place.lon}, place.label, []
+    if match.kind == "ambiguous":
+        return None, city_name, [place.label for place in match.places]
+    coords = get_coords_from_city(city_name)
+    if coords:
+        return coords, city_name, []
+    return None, city_name, [place.label for place in match.places]
+
+def get_coords_from_city(city_name):
+    """地名から座標を取得する関数（プロセス内キャッシュ → DBキャッシュ → APIの順に参照）"""
+    with metrics.timed("geocode", "lookup") as timer:
+        coords, timer.outcome = _lookup_coords(city_name)
+        return coords
+
+def _lookup_coords(city_name):
+    """(座標またはNone, 結果の種類) を返す"""
+    key = normalize_city_name(city_name)
+    try:
+        # キャッシュは正規化した地名そのものだけで保存し、別の表記からは見つかった座標だけを使う
+        # （「大阪区」が見つからなかったことを「大阪市」に持ち込まない）
+        for alias in [key] + city_name_aliases(key):
+            found, coords, outcome = _cached_coords(alias)
+            if found and (coords or alias == key):
+                _count("memory_hits" if outcome == "memory_hit" else "db_hits")
+                if coords is None: _count("negative_hits")
+                return coords, outcome
+    except Exception as e:
+        # キャッシュの不調で地名検索自体を止めないよう、APIでの検索に進む
+        print(f"Geocoding Cache Error: {e}")
+
+    _count("misses")
+    try:
+        coords = fetch_coords_from_api(city_name)
+    except Exception as e:
+        print(f"Geocoding API Error: {e}")
+        return None, "error"
+
+    try:
+        _remember(key, coords)
+    except Exception as e:
+        print(f"Geocoding Cache Error: {e}")
+    return coords, "api_found" if coords else "api_not_found"
+
+metrics.gauge(
+    "weatherbot_geocode_cache_events_total", "ジオコーディングキャッシュのヒット・ミス・API呼び出しの回数",
+    lambda: {(name,): value for name, value in get_cache_stats().items() if name in _stats}, ("event",),
+)
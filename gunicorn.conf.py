@@ -0,0 +1,19 @@
+# gunicornの設定（gunicorn app:app で起動すると自動で読み込まれる）
+import os
+
+# Renderなどが指定するポートで待ち受ける
+if os.environ.get("PORT"):
+    bind = f"0.0.0.0:{os.environ['PORT']}"
+
+# アプリをマスタープロセスで1回だけ読み込み、ワーカーはforkで引き継ぐ（ワーカーごとの読み込み時間をなくす）
+preload_app = True
+
+def when_ready(server):
+    # ワーカーを起動する前に、重いモジュールの読み込みなどもマスタープロセスで済ませておく
+    import app
+    app.preload()
+
+def post_fork(server, worker):
+    # fork前に作成したDBのコネクションプールは、子プロセスでは使わない
+    import database
+    database.dispose_engine()
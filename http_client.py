@@ -0,0 +1,165 @@
+import os
+import time
+import threading
+from urllib.parse import urlsplit
+import requests
+from requests.adapters import HTTPAdapter
+from dotenv import load_dotenv
+import metrics
+
+load_dotenv()
+
+# 接続・読み込みのタイムアウト（秒）
+HTTP_CONNECT_TIMEOUT = float(os.environ.get("HTTP_CONNECT_TIMEOUT", "3.05"))
+HTTP_READ_TIMEOUT = float(os.environ.get("HTTP_READ_TIMEOUT", "10"))
+# ホストごとに保持するKeep-Alive接続の数
+HTTP_POOL_SIZE = int(os.environ.get("HTTP_POOL_SIZE", "32"))
+# 連続して何回失敗したらサーキットブレーカーを開くか、開いてから何秒後に試行を再開するか
+BREAKER_FAILURE_THRESHOLD = int(os.environ.get("BREAKER_FAILURE_THRESHOLD", "5"))
+BREAKER_RESET_TIMEOUT = float(os.environ.get("BREAKER_RESET_TIMEOUT", "30"))
+
+# 外部サービスのベースURL（ベンチマークなどでローカルのモックサーバーに向けるときに上書きする）
+LINE_API_BASE_URL = os.environ.get("LINE_API_BASE_URL", "https://api.line.me")
+LINE_DATA_API_BASE_URL = os.environ.get("LINE_DATA_API_BASE_URL", "https://api-data.line.me")
+OPEN_METEO_BASE_URL = os.environ.get("OPEN_METEO_BASE_URL", "https://api.open-meteo.com")
+OPENWEATHER_BASE_URL = os.environ.get("OPENWEATHER_BASE_URL", "http://api.openweathermap.org")
+
+# ホスト（ポート番号を含む）と、サーキットブレーカーを共有する外部サービス名の対応
+UPSTREAMS = {
+    urlsplit(LINE_API_BASE_URL).netloc: "line",
+    urlsplit(LINE_DATA_API_BASE_URL).netloc: "line",
+    urlsplit(OPEN_METEO_BASE_URL).netloc: "open_meteo",
+    urlsplit(OPENWEATHER_BASE_URL).netloc: "geocoding",
+}
+# レイテンシのヒストグラムのバケット上限（秒）
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, float("inf"))
+
+class CircuitOpenError(requests.exceptions.RequestException):
+    """サーキットブレーカーが開いているため、リクエストを送らずに失敗させたことを表す例外"""
+
+class CircuitBreaker:
+    """外部サービスごとの連続失敗を数え、しきい値を超えたら一定時間リクエストを遮断するクラス"""
+
+    def __init__(self, name, failure_threshold=BREAKER_FAILURE_THRESHOLD, reset_timeout=BREAKER_RESET_TIMEOUT):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.lock = threading.Lock()
+        self.failures = 0
+        self.opened_at = None
+        self.trial_in_progress = False
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            return "half_open"
+        return "open"
+
+    def before_request(self):
+        """リクエストを送ってよいか判定し、遮断中ならCircuitOpenErrorを送出する"""
+        with self.lock:
+            state = self.state
+            if state == "closed":
+                return
+            # 半開状態では、1件だけ試しに通して復旧したかを確かめる
+            if state == "half_open" and not self.trial_in_progress:
+                self.trial_in_progress = True
+                return
+        raise CircuitOpenError(f"{self.name}へのリクエストを一時的に遮断しています（サーキットブレーカー作動中）")
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+            self.trial_in_progress = False
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            self.trial_in_progress = False
+            if self.opened_at is not None or self.failures >= self.failure_threshold:
+                if self.opened_at is None:
+                    print(f"{self.name}への連続失敗が{self.failures}回に達したため、サーキットブレーカーを開きます。")
+                self.opened_at = time.monotonic()
+
+HTTP_REQUEST_SECONDS = metrics.histogram("weatherbot_http_request_duration_seconds", "外部APIへのHTTPリクエストの処理時間（秒）", ("host", "outcome"), LATENCY_BUCKETS)
+
+_lock = threading.Lock()
+_sessions = {}
+_sessions_pid = None
+_breakers = {}
+
+def get_session(host):
+    """ホストごとに使い回すKeep-Alive接続付きのセッションを取得する関数"""
+    global _sessions, _sessions_pid
+    with _lock:
+        # fork後の子プロセスでは親の接続を使い回さない
+        if _sessions_pid != os.getpid():
+            _sessions, _sessions_pid = {}, os.getpid()
+        session = _sessions.get(host)
+        if session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=HTTP_POOL_SIZE)
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            _sessions[host] = session
+        return session
+
+def get_breaker(upstream):
+    """外部サービスのサーキットブレーカーを取得する関数"""
+    with _lock:
+        if upstream not in _breakers:
+            _breakers[upstream] = CircuitBreaker(upstream)
+        return _breakers[upstream]
+
+def request(method, url, **kwargs):
+    """タイムアウト・接続プール・サーキットブレーカー付きでHTTPリクエストを送る関数
+    5xx応答と通信エラーを失敗として数える。遮断中はCircuitOpenErrorを送出する。"""
+    host = urlsplit(url).netloc
+    breaker = get_breaker(UPSTREAMS.get(host, host))
+    breaker.before_request()
+    kwargs.setdefault("timeout", (HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT))
+    started_at = time.monotonic()
+    try:
+        response = get_session(host).request(method, url, **kwargs)
+    except requests.exceptions.RequestException:
+        breaker.record_failure()
+        HTTP_REQUEST_SECONDS.observe(time.monotonic() - started_at, host=host, outcome="error")
+        raise
+    HTTP_REQUEST_SECONDS.observe(time.monotonic() - started_at, host=host, outcome=str(response.status_code))
+    if response.status_code >= 500:
+        breaker.record_failure()
+    else:
+        breaker.record_success()
+    return response
+
+def get(url, **kwargs):
+    return request("GET", url, **kwargs)
+
+def post(url, **kwargs):
+    return request("POST", url, **kwargs)
+
+def delete(url, **kwargs):
+    return request("DELETE", url, **kwargs)
+
+def get_stats():
+    """サーキットブレーカーの状態とホストごとのレイテンシのヒストグラムを取得する関数"""
+    with _lock:
+        breakers = dict(_breakers)
+    latency = {}
+    for (host, outcome), item in HTTP_REQUEST_SECONDS.snapshot().items():
+        latency.setdefault(host, {})[outcome] = item
+    return {
+        "breakers": {name: {"state": breaker.state, "failures": breaker.failures} for name, breaker in breakers.items()},
+        "latency": latency,
+    }
+
+def _breaker_states():
+    with _lock:
+        breakers = dict(_breakers)
+    # 0: 正常, 1: 半開, 2: 遮断中
+    return {(name,): {"closed": 0, "half_open": 1, "open": 2}[breaker.state] for name, breaker in breakers.items()}
+
+metrics.gauge("weatherbot_circuit_breaker_state", "外部サービスごとのサーキットブレーカーの状態（0: 正常, 1: 半開, 2: 遮断中）", _breaker_states, ("upstream",))
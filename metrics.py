@@ -0,0 +1,202 @@
+import os
+import time
+import random
+import cProfile
+import functools
+import threading
+from contextlib import contextmanager
+
+# ヒストグラムのバケット上限（秒）
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, float("inf"))
+# Webhook処理のうちプロファイルを取る割合（0で無効）と、結果（.prof）の保存先
+PROFILE_SAMPLE_RATE = float(os.environ.get("PROFILE_SAMPLE_RATE", "0"))
+PROFILE_DIR = os.environ.get("PROFILE_DIR", "profiles")
+
+_lock = threading.Lock()
+_registry = {}
+
+def _format_labels(labelnames, values, extra=None):
+    pairs = list(zip(labelnames, values)) + list((extra or {}).items())
+    if not pairs:
+        return ""
+    escaped = ('{}="{}"'.format(name, str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")) for name, value in pairs)
+    return "{" + ",".join(escaped) + "}"
+
+class Counter:
+    """ラベルごとに加算していくカウンター"""
+    kind = "counter"
+
+    def __init__(self, name, help_text, labelnames=()):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def inc(self, value=1, **labels):
+        key = tuple(str(labels.get(name, "")) for name in self.labelnames)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + value
+
+    def samples(self):
+        with self.lock:
+            return [(self.name, _format_labels(self.labelnames, key), value) for key, value in sorted(self.values.items())]
+
+class Histogram:
+    """ラベルごとに値の分布を累積バケットで集計するヒストグラム"""
+    kind = "histogram"
+
+    def __init__(self, name, help_text, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self.lock = threading.Lock()
+        self.values = {}  # {ラベル値のタプル: [バケットごとの件数のリスト, 件数, 合計]}
+
+    def observe(self, value, **labels):
+        key = tuple(str(labels.get(name, "")) for name in self.labelnames)
+        with self.lock:
+            item = self.values.get(key)
+            if item is None:
+                item = self.values[key] = [[0] * len(self.buckets), 0, 0.0]
+            for i, upper in enumerate(self.buckets):
+                if value <= upper:
+                    item[0][i] += 1
+                    break
+            item[1] += 1
+            item[2] += value
+
+    def snapshot(self):
+        """{ラベルの辞書のタプル: {"count", "sum", "buckets"}} を返す"""
+        with self.lock:
+            result = {}
+            for key, (counts, count, total) in self.values.items():
+                cumulative, buckets = 0, {}
+                for upper, bucket_count in zip(self.buckets, counts):
+                    cumulative += bucket_count
+                    buckets["+Inf" if upper == float("inf") else str(upper)] = cumulative
+                result[key] = {"count": count, "sum": total, "buckets": buckets}
+            return result
+
+    def samples(self):
+        lines = []
+        for key, item in sorted(self.snapshot().items()):
+            for upper, cumulative in item["buckets"].items():
+                lines.append((f"{self.name}_bucket", _format_labels(self.labelnames, key, {"le": upper}), cumulative))
+            lines.append((f"{self.name}_count", _format_labels(self.labelnames, key), item["count"]))
+            lines.append((f"{self.name}_sum", _format_labels(self.labelnames, key), item["sum"]))
+        return lines
+
+class Gauge:
+    """呼び出した時点の値を関数から取得するゲージ（関数は {ラベル値のタプル: 値} または数値を返す）"""
+    kind = "gauge"
+
+    def __init__(self, name, help_text, labelnames, func):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self.func = func
+
+    def samples(self):
+        try:
+            values = self.func()
+        except Exception as e:
+            print(f"メトリクス({self.name})の取得エラー: {e}")
+            return []
+        if not isinstance(values, dict):
+            values = {(): values}
+        return [(self.name, _format_labels(self.labelnames, key), value) for key, value in sorted(values.items())]
+
+def _register(metric):
+    with _lock:
+        existing = _registry.get(metric.name)
+        if existing is not None and not isinstance(metric, Gauge):
+            return existing
+        _registry[metric.name] = metric
+        return metric
+
+def counter(name, help_text, labelnames=()):
+    """カウンターを登録する関数（同名のものがあればそれを返す）"""
+    return _register(Counter(name, help_text, labelnames))
+
+def histogram(name, help_text, labelnames=(), buckets=DEFAULT_BUCKETS):
+    """ヒストグラムを登録する関数（同名のものがあればそれを返す）"""
+    return _register(Histogram(name, help_text, labelnames, buckets))
+
+def gauge(name, help_text, func, labelnames=()):
+    """値を取得する関数を指定してゲージを登録する関数"""
+    return _register(Gauge(name, help_text, labelnames, func))
+
+# 処理段階（ジオコーディング・予報取得・Flex Messageの組み立て・LINE送信・DB）ごとの処理時間
+STAGE_SECONDS = histogram("weatherbot_stage_duration_seconds", "処理段階ごとの処理時間（秒）", ("stage", "operation", "outcome"))
+STAGE_TOTAL = counter("weatherbot_stage_total", "処理段階ごとの実行回数", ("stage", "operation", "outcome"))
+
+class _Timer:
+    def __init__(self):
+        self.outcome = "success"
+
+@contextmanager
+def timed(stage, operation):
+    """ブロックの処理時間を計測するコンテキストマネージャー
+    例外が発生した場合のoutcomeは "error"。それ以外の結果は timer.outcome に設定する。"""
+    timer = _Timer()
+    started_at = time.perf_counter()
+    try:
+        yield timer
+    except BaseException:
+        timer.outcome = "error"
+        raise
+    finally:
+        STAGE_SECONDS.observe(time.perf_counter() - started_at, stage=stage, operation=operation, outcome=timer.outcome)
+        STAGE_TOTAL.inc(stage=stage, operation=operation, outcome=timer.outcome)
+
+def instrument(stage, operation=None):
+    """関数の処理時間を計測するデコレーター（operationを省略すると関数名を使う）"""
+    def decorator(func):
+        name = operation or func.__name__
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with timed(stage, name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def render_prometheus():
+    """登録済みの全メトリクスを、Prometheusのテキスト形式で返す関数"""
+    with _lock:
+        metrics = list(_registry.values())
+    lines = []
+    for metric in metrics:
+        lines.append(f"# HELP {metric.name} {metric.help}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        for name, labels, value in metric.samples():
+            lines.append(f"{name}{labels} {value}")
+    return "\n".join(lines) + "\n"
+
+def print_summary(label):
+    """処理段階ごとの実行回数・合計時間・平均時間を出力する関数（バッチ処理の最後に呼び出す）"""
+    snapshot = STAGE_SECONDS.snapshot()
+    if not snapshot:
+        return
+    print(f"[{label}] 処理段階ごとの計測結果:")
+    for (stage, operation, outcome), item in sorted(snapshot.items(), key=lambda kv: -kv[1]["sum"]):
+        average_ms = item["sum"] / item["count"] * 1000 if item["count"] else 0.0
+        print(f"[{label}]   {stage}/{operation} ({outcome}): {item['count']}回, 合計 {item['sum']:.2f}秒, 平均 {average_ms:.1f}ms")
+
+@contextmanager
+def maybe_profile(name):
+    """PROFILE_SAMPLE_RATE の割合で、ブロックの処理をcProfileでプロファイルして保存するコンテキストマネージャー
+    プロファイルは現在のスレッドのみが対象。結果は python -m pstats などで確認する。"""
+    if PROFILE_SAMPLE_RATE <= 0 or random.random() >= PROFILE_SAMPLE_RATE:
+        yield
+        return
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        profiler.dump_stats(os.path.join(PROFILE_DIR, f"{name}-{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}-{threading.get_ident()}.prof"))
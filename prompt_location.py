@@ -1,43 +1,66 @@
 import os
-import requests
-import json
+import time
+from datetime import datetime
+from zoneinfo import ZoneInfo
 from dotenv import load_dotenv
-import database 
+import database
+import dispatcher
+import metrics
 
 load_dotenv()
 CHANNEL_ACCESS_TOKEN = os.environ.get("LINE_CHANNEL_ACCESS_TOKEN")
 
-def push_to_line(user_id, messages):
-    """LINE Messaging APIを通じてプッシュメッセージを送信する関数"""
-    headers = {"Content-Type": "application/json; charset=UTF-8", "Authorization": f"Bearer {CHANNEL_ACCESS_TOKEN}"}
-    body = {"to": user_id, "messages": messages}
-    try:
-        response = requests.post("https://api.line.me/v2/bot/message/push", headers=headers, data=json.dumps(body, ensure_ascii=False).encode('utf-8'))
-        response.raise_for_status()
-        print(f"ユーザー({user_id})への通知が成功しました。")
-    except requests.exceptions.RequestException as e:
-        print(f"ユーザー({user_id})へのLINE通知エラー: {e}")
-        if e.response: print(f"応答内容: {e.response.text}")
-
-def prompt_unregistered_users_for_location():
-    print("地点未登録ユーザーへのメッセージ送信を開始します...")
-    database.init_db() # データベース接続を初期化
-
-    # 地点未登録のユーザーIDリストを取得
-    unregistered_user_ids = database.get_users_without_location()
-
-    if not unregistered_user_ids:
-        print("地点未登録のユーザーは見つかりませんでした。")
-        return
+# 配信方式: "multicast"（まとめて送信）または "push"（1ユーザーずつ送信）
+DELIVERY_MODE = os.environ.get("NOTIFY_DELIVERY_MODE", "multicast")
+# 同じユーザーに次に送るまでの間隔（日）。n回目を送った後は n番目の間隔を空け、最後の間隔はそれ以降も繰り返す
+PROMPT_BACKOFF_DAYS = [float(days) for days in os.environ.get("PROMPT_BACKOFF_DAYS", "3,7,14,30").split(",")]
+# 1人のユーザーに送る最大回数（0なら上限なし）
+PROMPT_MAX_COUNT = int(os.environ.get("PROMPT_MAX_COUNT", "0"))
+
+def next_prompt_at(prompt_count, prompted_at):
+    """prompt_count回目を送った後、次に送ってよい時刻（UNIX時刻）を返す関数（もう送らない場合はNone）"""
+    if PROMPT_MAX_COUNT and prompt_count >= PROMPT_MAX_COUNT:
+        return None
+    days = PROMPT_BACKOFF_DAYS[min(prompt_count, len(PROMPT_BACKOFF_DAYS)) - 1]
+    return prompted_at + days * 24 * 3600
+
+def prompt_unregistered_users_for_location(run_id=None):
+    # 同じ日に再実行した場合は、送信済みのユーザーをスキップする
+    run_id = run_id or f"prompt-{datetime.now(ZoneInfo('Asia/Tokyo')).date().isoformat()}"
+    print(f"地点未登録ユーザーへのメッセージ送信を開始します... (run_id: {run_id})")
+    database.auto_migrate()
 
     message_content = {
         "type": "text",
         "text": "毎日の天気予報を通知するために、地点の再登録をお願いします。\n通知を受け取りたい地名（例: 大阪市, 新宿区）をメッセージで送ってください。"
     }
 
-    for user_id in unregistered_user_ids:
-        print(f"ユーザー({user_id})に地点登録を促すメッセージを送信中...")
-        push_to_line(user_id, [message_content])
+    # 送る時期が来ている地点未登録のユーザーだけを、バッチごとに読み込んで送信する
+    started_at = time.time()
+    stats = dispatcher.DispatchStats()
+    user_count = 0
+    for due_users in database.iter_users_due_for_prompt(started_at):
+        user_count += len(due_users)
+        prompt_counts = dict(due_users)
+
+        def record(user_ids):
+            # 停止したワーカーの送信を送り直した場合は、このページ以外のユーザーも含まれるので、送った回数をDBから読み込む
+            counts = dict(prompt_counts)
+            counts.update(database.get_prompt_counts([user_id for user_id in user_ids if user_id not in prompt_counts]))
+            prompted_at = time.time()
+            database.record_prompts([
+                (user_id, counts[user_id] + 1, prompted_at, next_prompt_at(counts[user_id] + 1, prompted_at))
+                for user_id in user_ids
+            ])
+
+        deliveries = [(user_id, [message_content]) for user_id in prompt_counts]
+        dispatcher.dispatch(run_id, deliveries, mode=DELIVERY_MODE, stats=stats, on_delivered=record)
+
+    if not user_count:
+        print("送信対象の地点未登録ユーザーは見つかりませんでした。")
+        return
+    stats.report(run_id)
+    metrics.print_summary(run_id)
 
     print("地点未登録ユーザーへのメッセージ送信が完了しました。")
 
@@ -0,0 +1,67 @@
+import os
+import sys
+import tempfile
+import unittest
+from unittest import mock
+from sqlalchemy import text
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import database
+import daily_notifier
+
+class NotificationJobsTest(unittest.TestCase):
+    """--claim-jobs のバッチが、ジョブ登録後に増えたユーザーも含めて、全員を漏れなく受け持つことの確認（一時ディレクトリのSQLiteを使う）"""
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.database_url = mock.patch.object(database, "DATABASE_URL", f"sqlite:///{os.path.join(self.tmp_dir.name, 'test.db')}")
+        self.database_url.start()
+        database._engine = None
+        database.init_db()
+        self.batch_size = mock.patch.object(database, "USER_BATCH_SIZE", 50)
+        self.batch_size.start()
+
+    def tearDown(self):
+        self.batch_size.stop()
+        database.get_engine().dispose()
+        database._engine = None
+        self.database_url.stop()
+        self.tmp_dir.cleanup()
+
+    def add_users(self, user_ids):
+        with database.get_engine().connect() as connection:
+            connection.execute(text("""
+                INSERT INTO users (user_id, state, city_name, lat, lon) VALUES (:user_id, 'normal', '大阪市', 34.69, 135.50)
+            """), [{"user_id": user_id} for user_id in user_ids])
+            connection.commit()
+
+    def process_jobs(self, run_id):
+        handled = []
+        daily_notifier.process_claimed_jobs(run_id, "worker", lambda users: handled.extend(user[0] for user in users))
+        return handled
+
+    def test_only_first_snapshot_creates_jobs(self):
+        self.add_users(f"U{i:04d}" for i in range(0, 200, 2))
+        first_snapshot = list(database.iter_user_id_ranges_with_location())
+        self.add_users(f"U{i:04d}" for i in range(1, 200, 2))
+        second_snapshot = list(database.iter_user_id_ranges_with_location())
+
+        self.assertTrue(database.create_notification_jobs("run", first_snapshot))
+        self.assertFalse(database.create_notification_jobs("run", second_snapshot))
+        with database.get_engine().connect() as connection:
+            jobs = connection.execute(text("SELECT first_user_id, last_user_id FROM notification_jobs WHERE run_id = 'run' ORDER BY batch_no")).fetchall()
+        self.assertEqual([tuple(job) for job in jobs], first_snapshot)
+
+    def test_users_added_after_job_creation_are_covered(self):
+        self.add_users(f"U{i:04d}" for i in range(0, 200, 2))
+        database.create_notification_jobs("run", list(database.iter_user_id_ranges_with_location()))
+        # ジョブの登録後に、バッチの間・最後のバッチの後ろのuser_idで地点を登録したユーザー
+        self.add_users([f"U{i:04d}" for i in range(1, 200, 2)] + ["U9999"])
+
+        handled = self.process_jobs("run")
+        self.assertEqual(sorted(handled), [f"U{i:04d}" for i in range(200)] + ["U9999"])
+        self.assertEqual(len(handled), len(set(handled)))
+
+if __name__ == "__main__":
+    unittest.main()
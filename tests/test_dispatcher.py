@@ -0,0 +1,111 @@
+import os
+import sys
+import json
+import tempfile
+import unittest
+from unittest import mock
+from sqlalchemy import text
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import database
+import dispatcher
+import prompt_location
+from flex_templates import encode_body, encode_messages
+
+MESSAGE = {"type": "text", "text": "地点の登録をお願いします。"}
+
+class FakeLine:
+    """LINEのPush/Multicast APIの代わり（受理済みのリトライキーには409を返す）"""
+
+    def __init__(self):
+        self.requests = []
+        self.accepted = set()
+
+    def post(self, url, headers=None, data=None):
+        retry_key = headers["X-Line-Retry-Key"]
+        self.requests.append((retry_key, json.loads(data)["to"]))
+        status_code = 409 if retry_key in self.accepted else 200
+        self.accepted.add(retry_key)
+        return mock.Mock(status_code=status_code, text="{}", headers={})
+
+class TakeOverStaleDeliveriesTest(unittest.TestCase):
+    """停止したワーカーが送信中のまま残した送信を、同じリトライキーで送り直すことの確認（一時ディレクトリのSQLiteを使う）"""
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.database_url = mock.patch.object(database, "DATABASE_URL", f"sqlite:///{os.path.join(self.tmp_dir.name, 'test.db')}")
+        self.database_url.start()
+        database._engine = None
+        database.init_db()
+        self.line = FakeLine()
+        self.post = mock.patch.object(dispatcher.http_client, "post", self.line.post)
+        self.post.start()
+
+    def tearDown(self):
+        self.post.stop()
+        database.get_engine().dispose()
+        database._engine = None
+        self.database_url.stop()
+        self.tmp_dir.cleanup()
+
+    def leave_stale_request(self, run_id, user_ids, retry_key, accepted=False):
+        """送信を引き受けてリクエストを保存した後に停止したワーカーの状態を作る（acceptedならLINEは受理済み）"""
+        database.claim_deliveries(run_id, user_ids, "dead-worker", retry_key)
+        body = encode_body({"to": user_ids}, encode_messages([MESSAGE])).decode("utf-8")
+        database.save_delivery_request(retry_key, run_id, dispatcher.MULTICAST_URL, body, "dead-worker")
+        self.expire_claims()
+        if accepted:
+            self.line.accepted.add(retry_key)
+
+    def expire_claims(self):
+        with database.get_engine().connect() as connection:
+            connection.execute(text("UPDATE delivery_checkpoints SET claimed_at = 0"))
+            connection.execute(text("UPDATE delivery_requests SET claimed_at = 0"))
+            connection.commit()
+
+    def statuses(self, run_id):
+        with database.get_engine().connect() as connection:
+            return dict(connection.execute(text("SELECT user_id, status FROM delivery_checkpoints WHERE run_id = :run_id"), {"run_id": run_id}).fetchall())
+
+    def test_stale_request_is_resent_with_same_retry_key(self):
+        user_ids = [f"U{i:04d}" for i in range(10)]
+        self.leave_stale_request("run", user_ids[:5], "stale-key", accepted=True)
+        delivered = []
+        stats = dispatcher.dispatch("run", [(user_id, [MESSAGE]) for user_id in user_ids], on_delivered=delivered.extend)
+
+        self.assertEqual(self.line.requests[0], ("stale-key", user_ids[:5]))
+        self.assertEqual([to for _, to in self.line.requests[1:]], [user_ids[5:]])
+        self.assertEqual(sorted(delivered), user_ids)
+        self.assertEqual(stats.delivered, 10)
+        self.assertEqual(set(self.statuses("run").values()), {"delivered"})
+        self.assertEqual(database.count_unconfirmed_deliveries("run"), 0)
+
+    def test_claim_without_saved_request_is_sent_normally(self):
+        database.claim_deliveries("run", ["U0001"], "dead-worker", "unsaved-key")
+        self.expire_claims()
+        dispatcher.dispatch("run", [("U0001", [MESSAGE])])
+
+        self.assertEqual(len(self.line.requests), 1)
+        self.assertNotEqual(self.line.requests[0][0], "unsaved-key")
+        self.assertEqual(self.statuses("run"), {"U0001": "delivered"})
+
+    def test_prompt_rerun_with_stale_request_across_pages(self):
+        user_ids = [f"U{i:04d}" for i in range(300)]
+        with database.get_engine().connect() as connection:
+            connection.execute(text("INSERT INTO users (user_id, state) VALUES (:user_id, 'normal')"), [{"user_id": user_id} for user_id in user_ids])
+            connection.commit()
+        # 前回の実行でまとめた送信が、今回の100件ずつのページの境目をまたいでいる
+        self.leave_stale_request("prompt-run", user_ids[50:150], "stale-key")
+
+        with mock.patch.object(database, "USER_BATCH_SIZE", 100):
+            prompt_location.prompt_unregistered_users_for_location("prompt-run")
+
+        self.assertIn(("stale-key", user_ids[50:150]), self.line.requests)
+        sent = [user_id for _, to in self.line.requests for user_id in to]
+        self.assertEqual(sorted(sent), user_ids)
+        self.assertEqual(database.get_prompt_counts(user_ids), dict.fromkeys(user_ids, 1))
+        self.assertEqual(database.count_unconfirmed_deliveries("prompt-run"), 0)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,107 @@
+import os
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import database
+import geocoding
+
+# APIが返す座標（ここにない地名は見つからない）
+API_RESULTS = {
+    "大阪市": {"lat": 34.69, "lon": 135.50},
+    "府中市": {"lat": 35.67, "lon": 139.48},
+    "府中町": {"lat": 34.39, "lon": 132.50},
+    "東京": {"lat": 35.68, "lon": 139.76},
+}
+
+class GeocodingTestCase(unittest.TestCase):
+    """一時ディレクトリのSQLiteと、API_RESULTSを返すAPIの代わりを使うテスト"""
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.database_url = mock.patch.object(database, "DATABASE_URL", f"sqlite:///{os.path.join(self.tmp_dir.name, 'test.db')}")
+        self.database_url.start()
+        database._engine = None
+        database.init_db()
+        geocoding._memory_cache.clear()
+        self.api_calls = []
+        self.fetch = mock.patch.object(geocoding, "fetch_coords_from_api", self.fake_fetch)
+        self.fetch.start()
+
+    def tearDown(self):
+        self.fetch.stop()
+        geocoding._memory_cache.clear()
+        database.get_engine().dispose()
+        database._engine = None
+        self.database_url.stop()
+        self.tmp_dir.cleanup()
+
+    def fake_fetch(self, city_name):
+        self.api_calls.append(city_name)
+        return API_RESULTS.get(city_name)
+
+class GeocodingCacheTest(GeocodingTestCase):
+    """地名の表記ゆれで、別の地名のキャッシュを使わないことの確認"""
+
+    def forget_memory_cache(self):
+        """別のプロセスから引いた場合と同じく、DBキャッシュだけが残った状態にする"""
+        geocoding._memory_cache.clear()
+
+    def test_not_found_ward_does_not_poison_city(self):
+        self.assertIsNone(geocoding.get_coords_from_city("大阪区"))
+        self.assertEqual(geocoding.get_coords_from_city("大阪市"), API_RESULTS["大阪市"])
+        self.assertEqual(self.api_calls, ["大阪区", "大阪市"])
+
+        self.forget_memory_cache()
+        self.assertEqual(geocoding.get_coords_from_city("大阪市"), API_RESULTS["大阪市"])
+        self.assertIsNone(geocoding.get_coords_from_city("大阪区"))
+        self.assertEqual(self.api_calls, ["大阪区", "大阪市"])
+
+    def test_town_does_not_use_city_entry(self):
+        self.assertEqual(geocoding.get_coords_from_city("府中市"), API_RESULTS["府中市"])
+        self.assertEqual(geocoding.get_coords_from_city("府中町"), API_RESULTS["府中町"])
+        self.assertEqual(self.api_calls, ["府中市", "府中町"])
+
+        self.forget_memory_cache()
+        self.assertEqual(geocoding.get_coords_from_city("府中町"), API_RESULTS["府中町"])
+        self.assertEqual(geocoding.get_coords_from_city("府中市"), API_RESULTS["府中市"])
+        self.assertEqual(self.api_calls, ["府中市", "府中町"])
+
+    def test_same_name_without_suffix_uses_found_entry(self):
+        self.assertEqual(geocoding.get_coords_from_city("大阪市"), API_RESULTS["大阪市"])
+        self.assertEqual(geocoding.get_coords_from_city("大阪"), API_RESULTS["大阪市"])
+        self.assertEqual(self.api_calls, ["大阪市"])
+
+class ResolveCityTest(GeocodingTestCase):
+    """同梱の地名辞書（全国の市区町村と政令市の区）で決まる地名はAPIを呼ばず、辞書にない地名だけAPIで探すことの確認"""
+
+    def test_names_in_gazetteer_resolve_without_api(self):
+        for city_name, expected_label in (("大阪市", "大阪市"), ("新宿区", "新宿区"), ("札幌", "札幌市"), ("さっぽろ", "札幌市"), ("東京都港区", "東京都港区"), ("名古屋市港区", "名古屋市港区")):
+            coords, label, suggestions = geocoding.resolve_city(city_name)
+            self.assertEqual((label, suggestions), (expected_label, []))
+            self.assertIsNotNone(coords)
+        self.assertEqual(self.api_calls, [])
+
+    def test_same_name_places_are_suggested(self):
+        coords, _, suggestions = geocoding.resolve_city("府中市")
+        self.assertIsNone(coords)
+        self.assertEqual(suggestions, ["東京都府中市", "広島県府中市"])
+        self.assertEqual(geocoding.resolve_city("港区")[2], ["東京都港区", "名古屋市港区", "大阪市港区"])
+        self.assertIn("広島市中区", geocoding.resolve_city("中区")[2])
+        self.assertEqual(self.api_calls, [])
+
+    def test_api_is_tried_before_prefix_and_typo_candidates(self):
+        self.assertEqual(geocoding.resolve_city("東京"), (API_RESULTS["東京"], "東京", []))
+        self.assertEqual(self.api_calls, ["東京"])
+
+    def test_candidates_are_suggested_when_api_does_not_find(self):
+        coords, _, suggestions = geocoding.resolve_city("大坂市")
+        self.assertIsNone(coords)
+        self.assertEqual(suggestions[0], "大阪市")
+        self.assertEqual(self.api_calls, ["大坂市"])
+
+if __name__ == "__main__":
+    unittest.main()
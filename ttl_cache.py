@@ -0,0 +1,39 @@
+import time
+import threading
+from collections import OrderedDict
+
+class TTLCache:
+    """有効期限付きのLRUキャッシュ（スレッドセーフ）"""
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.data = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        """(値, True) または期限切れ・未登録なら (None, False) を返す"""
+        with self.lock:
+            item = self.data.get(key)
+            if item is None:
+                return None, False
+            value, expires_at = item
+            if expires_at < time.time():
+                del self.data[key]
+                return None, False
+            self.data.move_to_end(key)
+            return value, True
+
+    def set(self, key, value, ttl):
+        with self.lock:
+            self.data[key] = (value, time.time() + ttl)
+            self.data.move_to_end(key)
+            while len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+
+    def delete(self, key):
+        with self.lock:
+            self.data.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
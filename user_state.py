@@ -0,0 +1,202 @@
+import os
+import time
+import uuid
+import select
+import threading
+import database
+import metrics
+from ttl_cache import TTLCache
+
+# ユーザー状態のプロセス内キャッシュの最大件数と有効期間（秒）。0件にするとキャッシュしない
+USER_STATE_CACHE_SIZE = int(os.environ.get("USER_STATE_CACHE_SIZE", "100000"))
+USER_STATE_CACHE_TTL = int(os.environ.get("USER_STATE_CACHE_TTL", "600"))
+# 複数プロセス間でキャッシュの無効化を伝える方法（local: 伝えない / postgres: LISTEN/NOTIFY / redis: Pub/Sub）
+# 省略時は、PostgreSQLを使っていれば postgres、そうでなければ local
+USER_STATE_CACHE_BACKEND = os.environ.get("USER_STATE_CACHE_BACKEND") or ("postgres" if database.is_postgres() else "local")
+USER_STATE_CHANNEL = os.environ.get("USER_STATE_CHANNEL", "weatherbot_user_state")
+REDIS_URL = os.environ.get("REDIS_URL", "redis://localhost:6379/0")
+# 1回の通知に含めるユーザーIDの数（NOTIFYのペイロードは8000バイトまで）
+INVALIDATION_CHUNK_SIZE = 200
+
+_cache = TTLCache(USER_STATE_CACHE_SIZE)
+# 自分が送った無効化通知を無視するための、このプロセスの識別子
+_instance_id = uuid.uuid4().hex
+# 無効化・書き込みのたびに増える番号。DBからの読み込み中に無効化・書き込みがあれば、読み込んだ値はキャッシュしない
+_generation = 0
+_generation_lock = threading.Lock()
+_listener_lock = threading.Lock()
+_listener_pid = None
+# 無効化通知を受け取れている間だけキャッシュを使う（取りこぼした通知があるかもしれないため）
+_listening = threading.Event()
+
+CACHE_TOTAL = metrics.counter("weatherbot_user_state_cache_total", "ユーザー状態キャッシュのヒット・ミスの回数", ("result",))
+
+def _invalidate(user_ids):
+    global _generation
+    with _generation_lock:
+        _generation += 1
+        for user_id in user_ids:
+            _cache.delete(user_id)
+
+def _invalidate_all():
+    global _generation
+    with _generation_lock:
+        _generation += 1
+        _cache.clear()
+
+def _handle_message(payload):
+    """無効化通知 "<送信元の識別子> <ユーザーID> <ユーザーID> ..." を処理する"""
+    sender, _, user_ids = payload.partition(" ")
+    if sender != _instance_id:
+        _invalidate(user_ids.split())
+
+def _listen_postgres():
+    connection = database.open_listen_connection(USER_STATE_CHANNEL)
+    try:
+        # 接続していなかった間の通知は受け取れていないので、LISTENを始めてからキャッシュを捨てて使い始める
+        _invalidate_all()
+        _listening.set()
+        while True:
+            if select.select([connection], [], [], 60) == ([], [], []):
+                continue
+            connection.poll()
+            while connection.notifies:
+                _handle_message(connection.notifies.pop(0).payload)
+    finally:
+        connection.close()
+
+def _listen_redis():
+    pubsub = _redis_client().pubsub(ignore_subscribe_messages=True)
+    pubsub.subscribe(USER_STATE_CHANNEL)
+    try:
+        _invalidate_all()
+        _listening.set()
+        for message in pubsub.listen():
+            data = message["data"]
+            _handle_message(data.decode() if isinstance(data, bytes) else data)
+    finally:
+        pubsub.close()
+
+_redis = None
+
+def _redis_client():
+    global _redis
+    if _redis is None:
+        # redisパッケージは、redisバックエンドを使う場合にだけ必要
+        import redis
+        _redis = redis.Redis.from_url(REDIS_URL)
+    return _redis
+
+def _listen_loop(listen):
+    delay = 1
+    while True:
+        try:
+            listen()
+            delay = 1
+        except Exception as e:
+            print(f"ユーザー状態キャッシュの無効化通知の受信エラー: {e}")
+        # 接続が切れている間の通知は受け取れないので、再接続するまでキャッシュを使わない
+        _listening.clear()
+        _invalidate_all()
+        time.sleep(delay)
+        delay = min(delay * 2, 60)
+
+def _ensure_listener():
+    """無効化通知を受け取るスレッドを（プロセスごとに1回）起動する"""
+    global _listener_pid
+    if _listener_pid == os.getpid():
+        return
+    with _listener_lock:
+        if _listener_pid == os.getpid():
+            return
+        # gunicornのpreloadなどでfork前にキャッシュされた値は使わない
+        _listening.clear()
+        _invalidate_all()
+        _listener_pid = os.getpid()
+        if USER_STATE_CACHE_BACKEND == "postgres" and database.is_postgres():
+            threading.Thread(target=_listen_loop, args=(_listen_postgres,), daemon=True).start()
+        elif USER_STATE_CACHE_BACKEND == "redis":
+            threading.Thread(target=_listen_loop, args=(_listen_redis,), daemon=True).start()
+        else:
+            _listening.set()
+
+def _cache_enabled():
+    if USER_STATE_CACHE_SIZE <= 0 or not database.DATABASE_URL:
+        return False
+    _ensure_listener()
+    return _listening.is_set()
+
+def _publish(user_ids):
+    """他のプロセスに、ユーザーの状態が変わったことを伝える"""
+    user_ids = list(user_ids)
+    payloads = [
+        " ".join([_instance_id] + user_ids[i:i + INVALIDATION_CHUNK_SIZE])
+        for i in range(0, len(user_ids), INVALIDATION_CHUNK_SIZE)
+    ]
+    try:
+        if USER_STATE_CACHE_BACKEND == "postgres":
+            database.notify(USER_STATE_CHANNEL, payloads)
+        elif USER_STATE_CACHE_BACKEND == "redis":
+            client = _redis_client()
+            for payload in payloads:
+                client.publish(USER_STATE_CHANNEL, payload)
+    except Exception as e:
+        # 他のプロセスのキャッシュは、有効期間が切れた時点で正しい状態に戻る
+        print(f"ユーザー状態キャッシュの無効化通知の送信エラー: {e}")
+
+def get_states(user_ids):
+    """複数ユーザーの状態を取得する関数（戻り値は {ユーザーID: 状態}）
+    キャッシュにないユーザーの分だけ、まとめてDBから読み込む。"""
+    if not _cache_enabled():
+        return database.get_user_states(user_ids)
+
+    states, missing = {}, []
+    for user_id in user_ids:
+        state, found = _cache.get(user_id)
+        if not found:
+            missing.append(user_id)
+        elif state is not None:
+            states[user_id] = state
+    CACHE_TOTAL.inc(len(user_ids) - len(missing), result="hit")
+    if not missing:
+        return states
+
+    CACHE_TOTAL.inc(len(missing), result="miss")
+    with _generation_lock:
+        generation = _generation
+    loaded = database.get_user_states(missing)
+    states.update(loaded)
+    with _generation_lock:
+        if generation == _generation:
+            # 未登録のユーザーも、状態がない（None）ことをキャッシュしておく
+            for user_id in missing:
+                _cache.set(user_id, loaded.get(user_id), USER_STATE_CACHE_TTL)
+    return states
+
+def set_states_and_locations(states, locations):
+    """複数ユーザーの状態と登録地をDBに書き込み、キャッシュにも反映する関数（引数は database.set_user_states_and_locations と同じ）"""
+    if not (states or locations):
+        return
+    database.set_user_states_and_locations(states, locations)
+    if USER_STATE_CACHE_SIZE <= 0 or not database.DATABASE_URL:
+        return
+    changed = dict.fromkeys(locations, 'normal')
+    changed.update(states)
+    # 無効化通知を受け取れていない間は、キャッシュに書き込まない（他のプロセスの変更を取りこぼした値が残りかねない）
+    write_through = _cache_enabled()
+    global _generation
+    with _generation_lock:
+        # 書き込み前に読み込んだ古い状態を、get_statesが後からキャッシュしないようにする
+        _generation += 1
+        if write_through:
+            for user_id, state in changed.items():
+                _cache.set(user_id, state, USER_STATE_CACHE_TTL)
+    _publish(changed)
+
+def get_cache_stats():
+    """ユーザー状態キャッシュの件数と、無効化通知の受信状況を取得する関数"""
+    return {
+        "backend": USER_STATE_CACHE_BACKEND,
+        "entries": len(_cache.data),
+        "listening": _listening.is_set(),
+    }
@@ -0,0 +1,129 @@
+import os
+import json
+import time
+import uuid
+import queue
+import threading
+import database
+import metrics
+
+# 処理方式: "memory"（プロセス内キュー）、"durable"（DBにも保存して再起動後に再処理）、"inline"（従来どおり受信時に処理）
+WEBHOOK_QUEUE_MODE = os.environ.get("WEBHOOK_QUEUE_MODE", "memory")
+WEBHOOK_WORKERS = int(os.environ.get("WEBHOOK_WORKERS", "4"))
+# durableモードで、処理中のまま放置された配信を他のワーカーが引き取るまでの秒数
+# （キューにある・処理中の配信は、この秒数の1/3ごとに引き受け時刻を更新して、他のプロセスに引き取られないようにする）
+WEBHOOK_EVENT_LEASE = int(os.environ.get("WEBHOOK_EVENT_LEASE", "300"))
+
+WAIT_SECONDS = metrics.histogram("weatherbot_webhook_queue_wait_seconds", "Webhookの配信がキューで待った時間（秒）", ("mode",))
+PROCESS_SECONDS = metrics.histogram("weatherbot_webhook_delivery_processing_seconds", "Webhookの配信1回分のイベントの処理時間（秒）", ("mode", "outcome"))
+
+def _summarize(snapshot):
+    count = sum(item["count"] for item in snapshot)
+    total = sum(item["sum"] for item in snapshot)
+    return {"count": count, "avg_seconds": total / count if count else 0.0}
+
+class WebhookQueue:
+    """Webhookの配信（1回のPOSTに含まれるイベントのリスト）を受け取り、ワーカースレッドでハンドラを実行するキュー"""
+
+    def __init__(self, process_delivery, mode=WEBHOOK_QUEUE_MODE, workers=WEBHOOK_WORKERS):
+        self.process_delivery = process_delivery
+        self.mode = mode
+        self.workers = workers
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.started_pid = None
+        # このプロセスのキューにある・処理中の配信ID（durableモード）
+        self.in_flight = set()
+        metrics.gauge("weatherbot_webhook_queue_depth", "キューに滞留しているWebhookの配信の数", lambda: self.queue.qsize())
+
+    def _ensure_started(self):
+        # gunicornのfork後にスレッドが引き継がれないため、プロセスごとに最初の利用時に起動する
+        with self.lock:
+            if self.started_pid == os.getpid():
+                return
+            self.queue = queue.Queue()
+            self.in_flight = set()
+            for _ in range(self.workers):
+                threading.Thread(target=self._worker, daemon=True).start()
+            if self.mode == "durable":
+                threading.Thread(target=self._recover_loop, daemon=True).start()
+            self.started_pid = os.getpid()
+
+    def enqueue(self, events):
+        """1回の配信に含まれるイベントをまとめてキューに積む関数（inlineモードではその場で処理する）"""
+        if not events:
+            return
+        if self.mode == "inline":
+            self._process(events, time.time(), None)
+            return
+
+        self._ensure_started()
+        now = time.time()
+        delivery_id = None
+        if self.mode == "durable":
+            delivery_id = str(uuid.uuid4())
+            database.save_webhook_events([(delivery_id, json.dumps([event.to_dict() for event in events]), now)])
+            with self.lock:
+                self.in_flight.add(delivery_id)
+        self.queue.put((events, now, delivery_id))
+
+    def _worker(self):
+        while True:
+            events, enqueued_at, delivery_id = self.queue.get()
+            try:
+                self._process(events, enqueued_at, delivery_id)
+            finally:
+                self.queue.task_done()
+
+    def _process(self, events, enqueued_at, delivery_id):
+        started_at = time.time()
+        WAIT_SECONDS.observe(started_at - enqueued_at, mode=self.mode)
+        if delivery_id is not None:
+            try:
+                # キューで待った分、引き受け時刻を更新して、処理中に他のプロセスに引き取られないようにする
+                database.touch_webhook_events([delivery_id])
+            except Exception as e:
+                print(f"Webhookイベントの引き受け時刻の更新エラー: {e}")
+        outcome = "success"
+        try:
+            self.process_delivery(events)
+        except Exception as e:
+            outcome = "error"
+            print(f"Webhookイベントの処理中にエラーが発生しました: {e}")
+        finally:
+            PROCESS_SECONDS.observe(time.time() - started_at, mode=self.mode, outcome=outcome)
+            if delivery_id is not None:
+                database.delete_webhook_event(delivery_id)
+                with self.lock:
+                    self.in_flight.discard(delivery_id)
+
+    def _recover_loop(self):
+        """durableモードで、処理されずに残った配信（停止したプロセスの分など）を定期的に引き取る"""
+        # linebot.v3.webhooksは読み込みに時間がかかるため、起動時ではなくここでimportする
+        from linebot.v3.webhooks import Event
+        while True:
+            try:
+                with self.lock:
+                    in_flight = set(self.in_flight)
+                # このプロセスで処理待ちの配信が、他のプロセスに引き取られないようにする
+                database.touch_webhook_events(in_flight)
+                for delivery_id, payload, enqueued_at in database.claim_stale_webhook_events(time.time() - WEBHOOK_EVENT_LEASE):
+                    with self.lock:
+                        if delivery_id in self.in_flight:
+                            continue
+                        self.in_flight.add(delivery_id)
+                    print(f"未処理のWebhookイベント({delivery_id})を再処理します。")
+                    self.queue.put(([Event.from_dict(event) for event in json.loads(payload)], enqueued_at, delivery_id))
+            except Exception as e:
+                print(f"未処理Webhookイベントの取得エラー: {e}")
+            time.sleep(WEBHOOK_EVENT_LEASE / 3)
+
+    def stats(self):
+        """キューの滞留数・待ち時間・処理時間を取得する関数"""
+        return {
+            "mode": self.mode,
+            "depth": self.queue.qsize(),
+            "wait": _summarize([item for key, item in WAIT_SECONDS.snapshot().items() if key[0] == self.mode]),
+            "processing": _summarize([item for key, item in PROCESS_SECONDS.snapshot().items() if key[0] == self.mode]),
+            "errors": sum(item["count"] for key, item in PROCESS_SECONDS.snapshot().items() if key == (self.mode, "error")),
+        }